@@ -21,6 +21,7 @@
 from resources.lib.modules import cleangenre
 from resources.lib.modules import control
 from resources.lib.modules import client
+from resources.lib.modules import ids
 from resources.lib.modules import metacache
 from resources.lib.modules import workers
 from resources.lib.modules import trakt
@@ -121,6 +122,8 @@ class channels:
         try:
             item = trakt.SearchAll(i[0], i[1], True)[0]
 
+            kind = 'movie' if item.get('movie') else 'show'
+
             content = item.get('movie')
             if not content: content = item.get('show')
             item = content
@@ -138,6 +141,8 @@ class channels:
 
             tmdb = str(item.get('ids', {}).get('tmdb', 0))
 
+            ids.record(kind, imdb, str(item.get('ids', {}).get('tvdb') or '0'), tmdb, title, year)
+
             premiered = item.get('released', '0')
             try: premiered = re.compile('(\d{4}-\d{2}-\d{2})').findall(premiered)[0]
             except: premiered = '0'
@@ -21,12 +21,14 @@ from resources.lib.modules import cleangenre
 from resources.lib.modules import control
 from resources.lib.modules import client
 from resources.lib.modules import cache
+from resources.lib.modules import ids
 from resources.lib.modules import playcount
+from resources.lib.modules import tvdbcache
 from resources.lib.modules import workers
 from resources.lib.modules import views
 from resources.lib.modules import utils
 
-import os,sys,re,json,zipfile,StringIO,urllib,urllib2,urlparse,datetime
+import os,sys,re,json,urllib,urlparse,datetime
 
 params = dict(urlparse.parse_qsl(sys.argv[2].replace('?',''))) if len(sys.argv) > 1 else dict()
 
@@ -47,8 +49,6 @@ class seasons:
         if self.tvdb_key == '' or self.tvdb_key == None:
             self.tvdb_key = '1D62F2F90030C444'
         self.tvdb_info_link = 'http://thetvdb.com/api/%s/series/%s/all/%s.zip' % (self.tvdb_key, '%s', '%s')
-        self.tvdb_by_imdb = 'http://thetvdb.com/api/GetSeriesByRemoteID.php?imdbid=%s'
-        self.tvdb_by_query = 'http://thetvdb.com/api/GetSeries.php?seriesname=%s'
         self.tvdb_image = 'http://thetvdb.com/banners/'
         self.tvdb_poster = 'http://thetvdb.com/banners/_cache/'
 
@@ -58,7 +58,7 @@ class seasons:
             return episodes().get(tvshowtitle, year, imdb, tvdb)
 
         if idx == True:
-            self.list = cache.get(self.tvdb_list, 24, tvshowtitle, year, imdb, tvdb, self.lang)
+            self.list = cache.get(seasons().tvdb_list, 24, tvshowtitle, year, imdb, tvdb, self.lang, refresh_ahead=True)
             if create_directory == True: self.seasonDirectory(self.list)
             return self.list
         else:
@@ -68,49 +68,7 @@ class seasons:
 
     def tvdb_list(self, tvshowtitle, year, imdb, tvdb, lang, limit=''):
         try:
-            if imdb == '0':
-                try:
-                    imdb = trakt.SearchTVShow(tvshowtitle, year, full=False)[0]
-                    imdb = imdb.get('show', '0')
-                    imdb = imdb.get('ids', {}).get('imdb', '0')
-                    imdb = 'tt' + re.sub('[^0-9]', '', str(imdb))
-
-                    if not imdb: imdb = '0'
-                except:
-                    imdb = '0'
-
-            if tvdb == '0' and not imdb == '0':
-                url = self.tvdb_by_imdb % imdb
-
-                result = client.request(url, timeout='10')
-
-                try: tvdb = client.parseDOM(result, 'seriesid')[0]
-                except: tvdb = '0'
-
-                try: name = client.parseDOM(result, 'SeriesName')[0]
-                except: name = '0'
-                dupe = re.compile('[***]Duplicate (\d*)[***]').findall(name)
-                if len(dupe) > 0: tvdb = str(dupe[0])
-
-                if tvdb == '': tvdb = '0'
-
-
-            if tvdb == '0':
-                url = self.tvdb_by_query % (urllib.quote_plus(tvshowtitle))
-
-                years = [str(year), str(int(year)+1), str(int(year)-1)]
-
-                tvdb = client.request(url, timeout='10')
-                tvdb = re.sub(r'[^\x00-\x7F]+', '', tvdb)
-                tvdb = client.replaceHTMLCodes(tvdb)
-                tvdb = client.parseDOM(tvdb, 'Series')
-                tvdb = [(x, client.parseDOM(x, 'SeriesName'), client.parseDOM(x, 'FirstAired')) for x in tvdb]
-                tvdb = [(x, x[1][0], x[2][0]) for x in tvdb if len(x[1]) > 0 and len(x[2]) > 0]
-                tvdb = [x for x in tvdb if cleantitle.get(tvshowtitle) == cleantitle.get(x[1])]
-                tvdb = [x[0][0] for x in tvdb if any(y in x[2] for y in years)][0]
-                tvdb = client.parseDOM(tvdb, 'seriesid')[0]
-
-                if tvdb == '': tvdb = '0'
+            imdb, tvdb = ids.show(imdb, tvdb, tvshowtitle, year)
         except:
             return
 
@@ -118,90 +76,57 @@ class seasons:
         try:
             if tvdb == '0': return
 
-            url = self.tvdb_info_link % (tvdb, 'en')
-            data = urllib2.urlopen(url, timeout=30).read()
-
-            zip = zipfile.ZipFile(StringIO.StringIO(data))
-            result = zip.read('%s.xml' % 'en')
-            artwork = zip.read('banners.xml')
-            zip.close()
-
-            dupe = client.parseDOM(result, 'SeriesName')[0]
-            dupe = re.compile('[***]Duplicate (\d*)[***]').findall(dupe)
-
-            if len(dupe) > 0:
-                tvdb = str(dupe[0]).encode('utf-8')
-
-                url = self.tvdb_info_link % (tvdb, 'en')
-                data = urllib2.urlopen(url, timeout=30).read()
-
-                zip = zipfile.ZipFile(StringIO.StringIO(data))
-                result = zip.read('%s.xml' % 'en')
-                artwork = zip.read('banners.xml')
-                zip.close()
+            bundle = tvdbcache.get(self.tvdb_info_link, tvdb, 'en')
+            tvdb = bundle['id'].encode('utf-8')
 
             if not lang == 'en':
-                url = self.tvdb_info_link % (tvdb, lang)
-                data = urllib2.urlopen(url, timeout=30).read()
-
-                zip = zipfile.ZipFile(StringIO.StringIO(data))
-                result2 = zip.read('%s.xml' % lang)
-                zip.close()
+                bundle2 = tvdbcache.get(self.tvdb_info_link, tvdb, lang) or bundle
             else:
-                result2 = result
-
+                bundle2 = bundle
 
-            artwork = artwork.split('<Banner>')
-            artwork = [i for i in artwork if '<Language>en</Language>' in i and '<BannerType>season</BannerType>' in i]
-            artwork = [i for i in artwork if not 'seasonswide' in re.findall('<BannerPath>(.+?)</BannerPath>', i)[0]]
 
+            artwork = [i for i in bundle['banners'] if i.get('Language') == 'en' and i.get('BannerType') == 'season']
+            artwork = [i for i in artwork if not 'seasonswide' in i.get('BannerPath', '')]
 
-            result = result.split('<Episode>')
-            result2 = result2.split('<Episode>')
 
-            item = result[0] ; item2 = result2[0]
+            item = bundle['series'] ; item2 = bundle2['series']
 
-            episodes = [i for i in result if '<EpisodeNumber>' in i]
+            episodes = [i for i in bundle['episodes'] if 'EpisodeNumber' in i]
             if control.setting('tv.specials') == 'true':
                 episodes = [i for i in episodes]
             else:
-                episodes = [i for i in episodes if not '<SeasonNumber>0</SeasonNumber>' in i]
-                episodes = [i for i in episodes if not '<EpisodeNumber>0</EpisodeNumber>' in i]
+                episodes = [i for i in episodes if not i.get('SeasonNumber') == '0']
+                episodes = [i for i in episodes if not i['EpisodeNumber'] == '0']
 
-            seasons = [i for i in episodes if '<EpisodeNumber>1</EpisodeNumber>' in i]
+            seasons = [i for i in episodes if i['EpisodeNumber'] == '1']
 
-            locals = [i for i in result2 if '<EpisodeNumber>' in i]
-
-            result = '' ; result2 = ''
+            locals = dict((i.get('id'), i) for i in bundle2['episodes'])
 
             if limit == '':
                 episodes = []
             elif limit == '-1':
                 seasons = []
             else:
-                episodes = [i for i in episodes if '<SeasonNumber>%01d</SeasonNumber>' % int(limit) in i]
+                episodes = [i for i in episodes if i.get('SeasonNumber') == '%01d' % int(limit)]
                 seasons = []
 
 
-            try: poster = client.parseDOM(item, 'poster')[0]
+            try: poster = item['poster']
             except: poster = ''
             if not poster == '': poster = self.tvdb_image + poster
             else: poster = '0'
-            poster = client.replaceHTMLCodes(poster)
             poster = poster.encode('utf-8')
 
-            try: banner = client.parseDOM(item, 'banner')[0]
+            try: banner = item['banner']
             except: banner = ''
             if not banner == '': banner = self.tvdb_image + banner
             else: banner = '0'
-            banner = client.replaceHTMLCodes(banner)
             banner = banner.encode('utf-8')
 
-            try: fanart = client.parseDOM(item, 'fanart')[0]
+            try: fanart = item['fanart']
             except: fanart = ''
             if not fanart == '': fanart = self.tvdb_image + fanart
             else: fanart = '0'
-            fanart = client.replaceHTMLCodes(fanart)
             fanart = fanart.encode('utf-8')
 
             if not poster == '0': pass
@@ -212,65 +137,56 @@ class seasons:
             elif not fanart == '0': banner = fanart
             elif not poster == '0': banner = poster
 
-            try: status = client.parseDOM(item, 'Status')[0]
+            try: status = item['Status']
             except: status = ''
             if status == '': status = 'Ended'
-            status = client.replaceHTMLCodes(status)
             status = status.encode('utf-8')
 
-            try: studio = client.parseDOM(item, 'Network')[0]
+            try: studio = item['Network']
             except: studio = ''
             if studio == '': studio = '0'
-            studio = client.replaceHTMLCodes(studio)
             studio = studio.encode('utf-8')
 
-            try: genre = client.parseDOM(item, 'Genre')[0]
+            try: genre = item['Genre']
             except: genre = ''
             genre = [x for x in genre.split('|') if not x == '']
             genre = ' / '.join(genre)
             if genre == '': genre = '0'
-            genre = client.replaceHTMLCodes(genre)
             genre = genre.encode('utf-8')
 
-            try: duration = client.parseDOM(item, 'Runtime')[0]
+            try: duration = item['Runtime']
             except: duration = ''
             if duration == '': duration = '0'
-            duration = client.replaceHTMLCodes(duration)
             duration = duration.encode('utf-8')
 
-            try: rating = client.parseDOM(item, 'Rating')[0]
+            try: rating = item['Rating']
             except: rating = ''
             if rating == '': rating = '0'
-            rating = client.replaceHTMLCodes(rating)
             rating = rating.encode('utf-8')
 
-            try: votes = client.parseDOM(item, 'RatingCount')[0]
+            try: votes = item['RatingCount']
             except: votes = '0'
             if votes == '': votes = '0'
-            votes = client.replaceHTMLCodes(votes)
             votes = votes.encode('utf-8')
 
-            try: mpaa = client.parseDOM(item, 'ContentRating')[0]
+            try: mpaa = item['ContentRating']
             except: mpaa = ''
             if mpaa == '': mpaa = '0'
-            mpaa = client.replaceHTMLCodes(mpaa)
             mpaa = mpaa.encode('utf-8')
 
-            try: cast = client.parseDOM(item, 'Actors')[0]
+            try: cast = item['Actors']
             except: cast = ''
             cast = [x for x in cast.split('|') if not x == '']
             try: cast = [(x.encode('utf-8'), '') for x in cast]
             except: cast = []
 
-            try: label = client.parseDOM(item2, 'SeriesName')[0]
+            try: label = item2['SeriesName']
             except: label = '0'
-            label = client.replaceHTMLCodes(label)
             label = label.encode('utf-8')
 
-            try: plot = client.parseDOM(item2, 'Overview')[0]
+            try: plot = item2['Overview']
             except: plot = ''
             if plot == '': plot = '0'
-            plot = client.replaceHTMLCodes(plot)
             plot = plot.encode('utf-8')
             
             unaired = ''
@@ -280,9 +196,8 @@ class seasons:
 
         for item in seasons:
             try:
-                premiered = client.parseDOM(item, 'FirstAired')[0]
+                premiered = item['FirstAired']
                 if premiered == '' or '-00' in premiered: premiered = '0'
-                premiered = client.replaceHTMLCodes(premiered)
                 premiered = premiered.encode('utf-8')
 
                 if status == 'Ended': pass
@@ -291,16 +206,15 @@ class seasons:
                     unaired = 'true'
                     if self.showunaired != 'true': raise Exception()
 
-                season = client.parseDOM(item, 'SeasonNumber')[0]
+                season = item['SeasonNumber']
                 season = '%01d' % int(season)
                 season = season.encode('utf-8')
 
-                thumb = [i for i in artwork if client.parseDOM(i, 'Season')[0] == season]
-                try: thumb = client.parseDOM(thumb[0], 'BannerPath')[0]
+                thumb = [i for i in artwork if i.get('Season') == season]
+                try: thumb = thumb[0]['BannerPath']
                 except: thumb = ''
                 if not thumb == '': thumb = self.tvdb_image + thumb
                 else: thumb = '0'
-                thumb = client.replaceHTMLCodes(thumb)
                 thumb = thumb.encode('utf-8')
 
                 if thumb == '0': thumb = poster
@@ -312,9 +226,8 @@ class seasons:
 
         for item in episodes:
             try:
-                premiered = client.parseDOM(item, 'FirstAired')[0]
+                premiered = item['FirstAired']
                 if premiered == '' or '-00' in premiered: premiered = '0'
-                premiered = client.replaceHTMLCodes(premiered)
                 premiered = premiered.encode('utf-8')
 
                 if status == 'Ended': pass
@@ -323,69 +236,61 @@ class seasons:
                     unaired = 'true'
                     if self.showunaired != 'true': raise Exception()
 
-                season = client.parseDOM(item, 'SeasonNumber')[0]
+                season = item['SeasonNumber']
                 season = '%01d' % int(season)
                 season = season.encode('utf-8')
 
-                episode = client.parseDOM(item, 'EpisodeNumber')[0]
+                episode = item['EpisodeNumber']
                 episode = re.sub('[^0-9]', '', '%01d' % int(episode))
                 episode = episode.encode('utf-8')
 
-                title = client.parseDOM(item, 'EpisodeName')[0]
+                title = item['EpisodeName']
                 if title == '': title = '0'
-                title = client.replaceHTMLCodes(title)
                 title = title.encode('utf-8')
 
 
-                try: thumb = client.parseDOM(item, 'filename')[0]
+                try: thumb = item['filename']
                 except: thumb = ''
                 if not thumb == '': thumb = self.tvdb_image + thumb
                 else: thumb = '0'
-                thumb = client.replaceHTMLCodes(thumb)
                 thumb = thumb.encode('utf-8')
 
                 if not thumb == '0': pass
                 elif not fanart == '0': thumb = fanart.replace(self.tvdb_image, self.tvdb_poster)
                 elif not poster == '0': thumb = poster
 
-                try: rating = client.parseDOM(item, 'Rating')[0]
+                try: rating = item['Rating']
                 except: rating = ''
                 if rating == '': rating = '0'
-                rating = client.replaceHTMLCodes(rating)
                 rating = rating.encode('utf-8')
 
-                try: director = client.parseDOM(item, 'Director')[0]
+                try: director = item['Director']
                 except: director = ''
                 director = [x for x in director.split('|') if not x == '']
                 director = ' / '.join(director)
                 if director == '': director = '0'
-                director = client.replaceHTMLCodes(director)
                 director = director.encode('utf-8')
 
-                try: writer = client.parseDOM(item, 'Writer')[0]
+                try: writer = item['Writer']
                 except: writer = ''
                 writer = [x for x in writer.split('|') if not x == '']
                 writer = ' / '.join(writer)
                 if writer == '': writer = '0'
-                writer = client.replaceHTMLCodes(writer)
                 writer = writer.encode('utf-8')
 
                 try:
-                    local = client.parseDOM(item, 'id')[0]
-                    local = [x for x in locals if '<id>%s</id>' % str(local) in x][0]
+                    local = locals[item['id']]
                 except:
                     local = item
 
-                label = client.parseDOM(local, 'EpisodeName')[0]
+                label = local['EpisodeName']
                 if label == '': label = '0'
-                label = client.replaceHTMLCodes(label)
                 label = label.encode('utf-8')
 
-                try: episodeplot = client.parseDOM(local, 'Overview')[0]
+                try: episodeplot = local['Overview']
                 except: episodeplot = ''
                 if episodeplot == '': episodeplot = '0'
                 if episodeplot == '0': episodeplot = plot
-                episodeplot = client.replaceHTMLCodes(episodeplot)
                 try: episodeplot = episodeplot.encode('utf-8')
                 except: pass
 
@@ -563,11 +468,11 @@ class episodes:
         try:
             if idx == True:
                 if season == None and episode == None:
-                    self.list = cache.get(seasons().tvdb_list, 1, tvshowtitle, year, imdb, tvdb, self.lang, '-1')
+                    self.list = cache.get(seasons().tvdb_list, 1, tvshowtitle, year, imdb, tvdb, self.lang, '-1', refresh_ahead=True)
                 elif episode == None:
-                    self.list = cache.get(seasons().tvdb_list, 1, tvshowtitle, year, imdb, tvdb, self.lang, season)
+                    self.list = cache.get(seasons().tvdb_list, 1, tvshowtitle, year, imdb, tvdb, self.lang, season, refresh_ahead=True)
                 else:
-                    self.list = cache.get(seasons().tvdb_list, 1, tvshowtitle, year, imdb, tvdb, self.lang, '-1')
+                    self.list = cache.get(seasons().tvdb_list, 1, tvshowtitle, year, imdb, tvdb, self.lang, '-1', refresh_ahead=True)
                     num = [x for x,y in enumerate(self.list) if y['season'] == str(season) and  y['episode'] == str(episode)][-1]
                     self.list = [y for x,y in enumerate(self.list) if x >= num]
 
@@ -586,27 +491,21 @@ class episodes:
             except: pass
 
             if self.trakt_link in url and url == self.onDeck_link:
-                self.blist = cache.get(self.trakt_episodes_list, 720, url, self.trakt_user, self.lang)
-                self.list = []
-                self.list = cache.get(self.trakt_episodes_list, 0, url, self.trakt_user, self.lang)
+                self.list = self.trakt_incremental(self.trakt_episodes_list, url)
                 self.list = self.list[::-1]
 
             elif self.trakt_link in url and url == self.progress_link:
-                self.blist = cache.get(self.trakt_progress_list, 720, url, self.trakt_user, self.lang)
-                self.list = []
-                self.list = cache.get(self.trakt_progress_list, 0, url, self.trakt_user, self.lang)
+                self.list = self.trakt_incremental(self.trakt_progress_list, url)
 
             elif self.trakt_link in url and url == self.mycalendar_link:
-                self.blist = cache.get(self.trakt_episodes_list, 720, url, self.trakt_user, self.lang)
-                self.list = []
-                self.list = cache.get(self.trakt_episodes_list, 0, url, self.trakt_user, self.lang)
+                self.list = self.trakt_incremental(self.trakt_episodes_list, url)
 
             elif self.trakt_link in url and '/users/' in url:
                 self.list = cache.get(self.trakt_list, 0, url, self.trakt_user)
                 self.list = self.list[::-1]
 
             elif self.trakt_link in url:
-                self.list = cache.get(self.trakt_list, 1, url, self.trakt_user)
+                self.list = cache.get(episodes().trakt_list, 1, url, self.trakt_user, refresh_ahead=True)
 
 
             elif self.tvmaze_link in url and url == self.added_link:
@@ -616,7 +515,7 @@ class episodes:
                     self.list += cache.get(self.tvmaze_list, 720, url, True)
 
             elif self.tvmaze_link in url:
-                self.list = cache.get(self.tvmaze_list, 1, url, False)
+                self.list = cache.get(episodes().tvmaze_list, 1, url, False, refresh_ahead=True)
 
 
             self.episodeDirectory(self.list)
@@ -625,6 +524,20 @@ class episodes:
             pass
 
 
+    def trakt_incremental(self, function, url):
+        # the last list is kept while trakt has no episode activity newer than it, for at most an hour as
+        # episodes also air without any, and otherwise is rebuilt with only the shows that changed looked up
+        self.blist = cache.get(function, 720, url, self.trakt_user, self.lang)
+        self.list = []
+
+        try:
+            activity = trakt.getEpisodesActivity()
+            if activity == None or activity > cache.timeout(function, url, self.trakt_user, self.lang): raise Exception()
+            return cache.get(function, 1, url, self.trakt_user, self.lang)
+        except:
+            return cache.get(function, 0, url, self.trakt_user, self.lang)
+
+
     def widget(self):
         if trakt.getTraktIndicatorsInfo() == True:
             setting = control.setting('tv.widget.alt')
@@ -853,43 +766,26 @@ class episodes:
         except:
             pass
 
+        results = []
+
         def items_list(i):
-            try:
-                item = [x for x in self.blist if x['tvdb'] == i['tvdb'] and x['snum'] == i['snum'] and x['enum'] == i['enum']][0]
-                item['action'] = 'episodes'
-                self.list.append(item)
-                return
-            except:
-                pass
+            bundle = tvdbcache.get(self.tvdb_info_link, i['tvdb'], lang)
+            if not bundle: return
 
             try:
-                url = self.tvdb_info_link % (i['tvdb'], lang)
-                data = urllib2.urlopen(url, timeout=10).read()
+                item = [x for x in bundle['episodes'] if 'EpisodeNumber' in x]
+                item2 = bundle['series']
 
-                zip = zipfile.ZipFile(StringIO.StringIO(data))
-                result = zip.read('%s.xml' % lang)
-                artwork = zip.read('banners.xml')
-                zip.close()
-
-                result = result.split('<Episode>')
-                item = [x for x in result if '<EpisodeNumber>' in x]
-                item2 = result[0]
-
-                num = [x for x,y in enumerate(item) if re.compile('<SeasonNumber>(.+?)</SeasonNumber>').findall(y)[0] == str(i['snum']) and re.compile('<EpisodeNumber>(.+?)</EpisodeNumber>').findall(y)[0] == str(i['enum'])][-1]
+                num = [x for x,y in enumerate(item) if y.get('SeasonNumber') == str(i['snum']) and y['EpisodeNumber'] == str(i['enum'])][-1]
                 item = [y for x,y in enumerate(item) if x > num][0]
 
-                print lang
-                print item
-
-                premiered = client.parseDOM(item, 'FirstAired')[0]
+                premiered = item['FirstAired']
                 if premiered == '' or '-00' in premiered: premiered = '0'
-                premiered = client.replaceHTMLCodes(premiered)
                 premiered = premiered.encode('utf-8')
 
-                try: status = client.parseDOM(item2, 'Status')[0]
+                try: status = item2['Status']
                 except: status = ''
                 if status == '': status = 'Ended'
-                status = client.replaceHTMLCodes(status)
                 status = status.encode('utf-8')
                 
                 unaired = ''
@@ -900,16 +796,15 @@ class episodes:
                     unaired = 'true'
                     if self.showunaired != 'true': raise Exception()
 
-                title = client.parseDOM(item, 'EpisodeName')[0]
+                title = item['EpisodeName']
                 if title == '': title = '0'
-                title = client.replaceHTMLCodes(title)
                 title = title.encode('utf-8')
 
-                season = client.parseDOM(item, 'SeasonNumber')[0]
+                season = item['SeasonNumber']
                 season = '%01d' % int(season)
                 season = season.encode('utf-8')
 
-                episode = client.parseDOM(item, 'EpisodeNumber')[0]
+                episode = item['EpisodeNumber']
                 episode = re.sub('[^0-9]', '', '%01d' % int(episode))
                 episode = episode.encode('utf-8')
 
@@ -920,32 +815,28 @@ class episodes:
                 try: year = year.encode('utf-8')
                 except: pass
 
-                try: poster = client.parseDOM(item2, 'poster')[0]
+                try: poster = item2['poster']
                 except: poster = ''
                 if not poster == '': poster = self.tvdb_image + poster
                 else: poster = '0'
-                poster = client.replaceHTMLCodes(poster)
                 poster = poster.encode('utf-8')
 
-                try: banner = client.parseDOM(item2, 'banner')[0]
+                try: banner = item2['banner']
                 except: banner = ''
                 if not banner == '': banner = self.tvdb_image + banner
                 else: banner = '0'
-                banner = client.replaceHTMLCodes(banner)
                 banner = banner.encode('utf-8')
 
-                try: fanart = client.parseDOM(item2, 'fanart')[0]
+                try: fanart = item2['fanart']
                 except: fanart = ''
                 if not fanart == '': fanart = self.tvdb_image + fanart
                 else: fanart = '0'
-                fanart = client.replaceHTMLCodes(fanart)
                 fanart = fanart.encode('utf-8')
 
-                try: thumb = client.parseDOM(item, 'filename')[0]
+                try: thumb = item['filename']
                 except: thumb = ''
                 if not thumb == '': thumb = self.tvdb_image + thumb
                 else: thumb = '0'
-                thumb = client.replaceHTMLCodes(thumb)
                 thumb = thumb.encode('utf-8')
 
                 if not poster == '0': pass
@@ -960,86 +851,94 @@ class episodes:
                 elif not fanart == '0': thumb = fanart.replace(self.tvdb_image, self.tvdb_poster)
                 elif not poster == '0': thumb = poster
 
-                try: studio = client.parseDOM(item2, 'Network')[0]
+                try: studio = item2['Network']
                 except: studio = ''
                 if studio == '': studio = '0'
-                studio = client.replaceHTMLCodes(studio)
                 studio = studio.encode('utf-8')
 
-                try: genre = client.parseDOM(item2, 'Genre')[0]
+                try: genre = item2['Genre']
                 except: genre = ''
                 genre = [x for x in genre.split('|') if not x == '']
                 genre = ' / '.join(genre)
                 if genre == '': genre = '0'
-                genre = client.replaceHTMLCodes(genre)
                 genre = genre.encode('utf-8')
 
-                try: duration = client.parseDOM(item2, 'Runtime')[0]
+                try: duration = item2['Runtime']
                 except: duration = ''
                 if duration == '': duration = '0'
-                duration = client.replaceHTMLCodes(duration)
                 duration = duration.encode('utf-8')
 
-                try: rating = client.parseDOM(item, 'Rating')[0]
+                try: rating = item['Rating']
                 except: rating = ''
                 if rating == '': rating = '0'
-                rating = client.replaceHTMLCodes(rating)
                 rating = rating.encode('utf-8')
 
-                try: votes = client.parseDOM(item2, 'RatingCount')[0]
+                try: votes = item2['RatingCount']
                 except: votes = '0'
                 if votes == '': votes = '0'
-                votes = client.replaceHTMLCodes(votes)
                 votes = votes.encode('utf-8')
 
-                try: mpaa = client.parseDOM(item2, 'ContentRating')[0]
+                try: mpaa = item2['ContentRating']
                 except: mpaa = ''
                 if mpaa == '': mpaa = '0'
-                mpaa = client.replaceHTMLCodes(mpaa)
                 mpaa = mpaa.encode('utf-8')
 
-                try: director = client.parseDOM(item, 'Director')[0]
+                try: director = item['Director']
                 except: director = ''
                 director = [x for x in director.split('|') if not x == '']
                 director = ' / '.join(director)
                 if director == '': director = '0'
-                director = client.replaceHTMLCodes(director)
                 director = director.encode('utf-8')
 
-                try: writer = client.parseDOM(item, 'Writer')[0]
+                try: writer = item['Writer']
                 except: writer = ''
                 writer = [x for x in writer.split('|') if not x == '']
                 writer = ' / '.join(writer)
                 if writer == '': writer = '0'
-                writer = client.replaceHTMLCodes(writer)
                 writer = writer.encode('utf-8')
 
-                try: cast = client.parseDOM(item2, 'Actors')[0]
+                try: cast = item2['Actors']
                 except: cast = ''
                 cast = [x for x in cast.split('|') if not x == '']
                 try: cast = [(x.encode('utf-8'), '') for x in cast]
                 except: cast = []
 
-                try: plot = client.parseDOM(item, 'Overview')[0]
+                try: plot = item['Overview']
                 except: plot = ''
                 if plot == '':
-                    try: plot = client.parseDOM(item2, 'Overview')[0]
+                    try: plot = item2['Overview']
                     except: plot = ''
                 if plot == '': plot = '0'
-                plot = client.replaceHTMLCodes(plot)
                 plot = plot.encode('utf-8')
 
-                self.list.append({'title': title, 'season': season, 'episode': episode, 'tvshowtitle': tvshowtitle, 'year': year, 'premiered': premiered, 'status': status, 'studio': studio, 'genre': genre, 'duration': duration, 'rating': rating, 'votes': votes, 'mpaa': mpaa, 'director': director, 'writer': writer, 'cast': cast, 'plot': plot, 'imdb': imdb, 'tvdb': tvdb, 'poster': poster, 'banner': banner, 'fanart': fanart, 'thumb': thumb, 'snum': i['snum'], 'enum': i['enum'], 'action': 'episodes', 'unaired': unaired, '_last_watched': i['_last_watched'], '_sort_key': max(i['_last_watched'],premiered)})
+                results.append((tvdb, {'title': title, 'season': season, 'episode': episode, 'tvshowtitle': tvshowtitle, 'year': year, 'premiered': premiered, 'status': status, 'studio': studio, 'genre': genre, 'duration': duration, 'rating': rating, 'votes': votes, 'mpaa': mpaa, 'director': director, 'writer': writer, 'cast': cast, 'plot': plot, 'imdb': imdb, 'tvdb': tvdb, 'poster': poster, 'banner': banner, 'fanart': fanart, 'thumb': thumb, 'snum': i['snum'], 'enum': i['enum'], 'unaired': unaired}))
             except:
-                pass
+                # nothing to list after the last watched episode
+                results.append((i['tvdb'], {}))
 
 
         items = items[:100]
 
-        threads = []
-        for i in items: threads.append(workers.Thread(items_list, i))
-        [i.start() for i in threads]
-        [i.join() for i in threads]
+        # the next episode of every show is kept per last watched episode, only shows watched
+        # since it was stored, or not looked up for a day as episodes air, are looked up again
+        keys = dict((i['tvdb'], 'progress:%s:%s:%s:%s:%s' % (i['tvdb'], i['snum'], i['enum'], lang, self.showunaired)) for i in items)
+        stored = cache.get_many('trakt', keys.values(), 24)
+
+        workers.pool.map(items_list, [i for i in items if not keys[i['tvdb']] in stored], timeout=30)
+        # shows that overran the deadline can't add to the list any more
+        found = dict(results)
+
+        # not tagged with the trakt user, marking an episode watched changes the key of that show only
+        try: cache.set_many('trakt', dict((keys[k], v) for k, v in found.iteritems() if k in keys))
+        except: pass
+
+        self.list = []
+        for i in items:
+            item = found.get(i['tvdb'], stored.get(keys[i['tvdb']]))
+            if not item: continue
+            item = dict(item)
+            item.update({'action': 'episodes', '_last_watched': i['_last_watched'], '_sort_key': max(i['_last_watched'], item['premiered'])})
+            self.list.append(item)
 
 
         try:
@@ -1055,50 +954,41 @@ class episodes:
     def trakt_episodes_list(self, url, user, lang):
         items = self.trakt_list(url, user)
 
+        results = []
+
         def items_list(i):
             try:
                 item = [x for x in self.blist if x['tvdb'] == i['tvdb'] and x['season'] == i['season'] and x['episode'] == i['episode']][0]
                 if item['poster'] == '0': raise Exception()
-                self.list.append(item)
+                results.append(item)
                 return
             except:
                 pass
 
             try:
-                url = self.tvdb_info_link % (i['tvdb'], lang)
-                data = urllib2.urlopen(url, timeout=10).read()
+                bundle = tvdbcache.get(self.tvdb_info_link, i['tvdb'], lang)
 
-                zip = zipfile.ZipFile(StringIO.StringIO(data))
-                result = zip.read('%s.xml' % lang)
-                artwork = zip.read('banners.xml')
-                zip.close()
+                item = [x for x in bundle['episodes'] if x.get('SeasonNumber') == '%01d' % int(i['season']) and x.get('EpisodeNumber') == '%01d' % int(i['episode'])][0]
+                item2 = bundle['series']
 
-                result = result.split('<Episode>')
-                item = [(re.findall('<SeasonNumber>%01d</SeasonNumber>' % int(i['season']), x), re.findall('<EpisodeNumber>%01d</EpisodeNumber>' % int(i['episode']), x), x) for x in result]
-                item = [x[2] for x in item if len(x[0]) > 0 and len(x[1]) > 0][0]
-                item2 = result[0]
-
-                premiered = client.parseDOM(item, 'FirstAired')[0]
+                premiered = item['FirstAired']
                 if premiered == '' or '-00' in premiered: premiered = '0'
-                premiered = client.replaceHTMLCodes(premiered)
                 premiered = premiered.encode('utf-8')
 
-                try: status = client.parseDOM(item2, 'Status')[0]
+                try: status = item2['Status']
                 except: status = ''
                 if status == '': status = 'Ended'
-                status = client.replaceHTMLCodes(status)
                 status = status.encode('utf-8')
 
-                title = client.parseDOM(item, 'EpisodeName')[0]
+                title = item['EpisodeName']
                 if title == '': title = '0'
-                title = client.replaceHTMLCodes(title)
                 title = title.encode('utf-8')
 
-                season = client.parseDOM(item, 'SeasonNumber')[0]
+                season = item['SeasonNumber']
                 season = '%01d' % int(season)
                 season = season.encode('utf-8')
 
-                episode = client.parseDOM(item, 'EpisodeNumber')[0]
+                episode = item['EpisodeNumber']
                 episode = re.sub('[^0-9]', '', '%01d' % int(episode))
                 episode = episode.encode('utf-8')
 
@@ -1109,32 +999,28 @@ class episodes:
                 try: year = year.encode('utf-8')
                 except: pass
 
-                try: poster = client.parseDOM(item2, 'poster')[0]
+                try: poster = item2['poster']
                 except: poster = ''
                 if not poster == '': poster = self.tvdb_image + poster
                 else: poster = '0'
-                poster = client.replaceHTMLCodes(poster)
                 poster = poster.encode('utf-8')
 
-                try: banner = client.parseDOM(item2, 'banner')[0]
+                try: banner = item2['banner']
                 except: banner = ''
                 if not banner == '': banner = self.tvdb_image + banner
                 else: banner = '0'
-                banner = client.replaceHTMLCodes(banner)
                 banner = banner.encode('utf-8')
 
-                try: fanart = client.parseDOM(item2, 'fanart')[0]
+                try: fanart = item2['fanart']
                 except: fanart = ''
                 if not fanart == '': fanart = self.tvdb_image + fanart
                 else: fanart = '0'
-                fanart = client.replaceHTMLCodes(fanart)
                 fanart = fanart.encode('utf-8')
 
-                try: thumb = client.parseDOM(item, 'filename')[0]
+                try: thumb = item['filename']
                 except: thumb = ''
                 if not thumb == '': thumb = self.tvdb_image + thumb
                 else: thumb = '0'
-                thumb = client.replaceHTMLCodes(thumb)
                 thumb = thumb.encode('utf-8')
 
                 if not poster == '0': pass
@@ -1149,86 +1035,76 @@ class episodes:
                 elif not fanart == '0': thumb = fanart.replace(self.tvdb_image, self.tvdb_poster)
                 elif not poster == '0': thumb = poster
 
-                try: studio = client.parseDOM(item2, 'Network')[0]
+                try: studio = item2['Network']
                 except: studio = ''
                 if studio == '': studio = '0'
-                studio = client.replaceHTMLCodes(studio)
                 studio = studio.encode('utf-8')
 
-                try: genre = client.parseDOM(item2, 'Genre')[0]
+                try: genre = item2['Genre']
                 except: genre = ''
                 genre = [x for x in genre.split('|') if not x == '']
                 genre = ' / '.join(genre)
                 if genre == '': genre = '0'
-                genre = client.replaceHTMLCodes(genre)
                 genre = genre.encode('utf-8')
 
-                try: duration = client.parseDOM(item2, 'Runtime')[0]
+                try: duration = item2['Runtime']
                 except: duration = ''
                 if duration == '': duration = '0'
-                duration = client.replaceHTMLCodes(duration)
                 duration = duration.encode('utf-8')
 
-                try: rating = client.parseDOM(item, 'Rating')[0]
+                try: rating = item['Rating']
                 except: rating = ''
                 if rating == '': rating = '0'
-                rating = client.replaceHTMLCodes(rating)
                 rating = rating.encode('utf-8')
 
-                try: votes = client.parseDOM(item2, 'RatingCount')[0]
+                try: votes = item2['RatingCount']
                 except: votes = '0'
                 if votes == '': votes = '0'
-                votes = client.replaceHTMLCodes(votes)
                 votes = votes.encode('utf-8')
 
-                try: mpaa = client.parseDOM(item2, 'ContentRating')[0]
+                try: mpaa = item2['ContentRating']
                 except: mpaa = ''
                 if mpaa == '': mpaa = '0'
-                mpaa = client.replaceHTMLCodes(mpaa)
                 mpaa = mpaa.encode('utf-8')
 
-                try: director = client.parseDOM(item, 'Director')[0]
+                try: director = item['Director']
                 except: director = ''
                 director = [x for x in director.split('|') if not x == '']
                 director = ' / '.join(director)
                 if director == '': director = '0'
-                director = client.replaceHTMLCodes(director)
                 director = director.encode('utf-8')
 
-                try: writer = client.parseDOM(item, 'Writer')[0]
+                try: writer = item['Writer']
                 except: writer = ''
                 writer = [x for x in writer.split('|') if not x == '']
                 writer = ' / '.join(writer)
                 if writer == '': writer = '0'
-                writer = client.replaceHTMLCodes(writer)
                 writer = writer.encode('utf-8')
 
-                try: cast = client.parseDOM(item2, 'Actors')[0]
+                try: cast = item2['Actors']
                 except: cast = ''
                 cast = [x for x in cast.split('|') if not x == '']
                 try: cast = [(x.encode('utf-8'), '') for x in cast]
                 except: cast = []
 
-                try: plot = client.parseDOM(item, 'Overview')[0]
+                try: plot = item['Overview']
                 except: plot = ''
                 if plot == '':
-                    try: plot = client.parseDOM(item2, 'Overview')[0]
+                    try: plot = item2['Overview']
                     except: plot = ''
                 if plot == '': plot = '0'
-                plot = client.replaceHTMLCodes(plot)
                 plot = plot.encode('utf-8')
 
-                self.list.append({'title': title, 'season': season, 'episode': episode, 'tvshowtitle': tvshowtitle, 'year': year, 'premiered': premiered, 'status': status, 'studio': studio, 'genre': genre, 'duration': duration, 'rating': rating, 'votes': votes, 'mpaa': mpaa, 'director': director, 'writer': writer, 'cast': cast, 'plot': plot, 'imdb': imdb, 'tvdb': tvdb, 'poster': poster, 'banner': banner, 'fanart': fanart, 'thumb': thumb})
+                results.append({'title': title, 'season': season, 'episode': episode, 'tvshowtitle': tvshowtitle, 'year': year, 'premiered': premiered, 'status': status, 'studio': studio, 'genre': genre, 'duration': duration, 'rating': rating, 'votes': votes, 'mpaa': mpaa, 'director': director, 'writer': writer, 'cast': cast, 'plot': plot, 'imdb': imdb, 'tvdb': tvdb, 'poster': poster, 'banner': banner, 'fanart': fanart, 'thumb': thumb})
             except:
                 pass
 
 
         items = items[:100]
 
-        threads = []
-        for i in items: threads.append(workers.Thread(items_list, i))
-        [i.start() for i in threads]
-        [i.join() for i in threads]
+        workers.pool.map(items_list, items, timeout=30)
+        # shows that overran the deadline can't add to the list any more
+        self.list = list(results)
 
         return self.list
 
@@ -20,9 +20,11 @@ from resources.lib.modules import cleangenre
 from resources.lib.modules import cleantitle
 from resources.lib.modules import control
 from resources.lib.modules import client
+from resources.lib.modules import dom_index
 from resources.lib.modules import cache
 from resources.lib.modules import metacache
 from resources.lib.modules import playcount
+from resources.lib.modules import progressive
 from resources.lib.modules import workers
 from resources.lib.modules import views
 from resources.lib.modules import utils
@@ -37,6 +39,8 @@ action = params.get('action')
 class movies:
     def __init__(self):
         self.list = []
+        self.deferred = None
+        self.progressive = False
 
         self.imdb_link = 'https://www.imdb.com'
         self.trakt_link = 'https://api.trakt.tv'
@@ -91,6 +95,8 @@ class movies:
 
     def get(self, url, idx=True, create_directory=True):
         try:
+            self.progressive = idx == True and create_directory == True and progressive.enabled()
+
             try: url = getattr(self, url + '_link')
             except: pass
 
@@ -103,9 +109,9 @@ class movies:
                     if url == self.trakthistory_link: raise Exception()
                     if not '/users/me/' in url: raise Exception()
                     if trakt.getActivity() > cache.timeout(self.trakt_list, url, self.trakt_user): raise Exception()
-                    self.list = cache.get(self.trakt_list, 720, url, self.trakt_user)
+                    self.list = cache.get(self.trakt_list, 720, url, self.trakt_user, tags=[trakt.userCacheTag()])
                 except:
-                    self.list = cache.get(self.trakt_list, 0, url, self.trakt_user)
+                    self.list = cache.get(self.trakt_list, 0, url, self.trakt_user, tags=[trakt.userCacheTag()])
 
                 if '/users/me/' in url and '/collection/' in url:
                     self.list = sorted(self.list, key=lambda k: utils.title_key(k['title']))
@@ -117,7 +123,7 @@ class movies:
                 if idx == True: self.worker(level=0)
 
             elif u in self.trakt_link:
-                self.list = cache.get(self.trakt_list, 24, url, self.trakt_user)
+                self.list = cache.get(movies().trakt_list, 24, url, self.trakt_user, refresh_ahead=True)
                 if idx == True: self.worker()
 
 
@@ -126,10 +132,17 @@ class movies:
                 if idx == True: self.worker()
 
             elif u in self.imdb_link:
-                self.list = cache.get(self.imdb_list, 24, url)
+                self.list = cache.get(movies().imdb_list, 24, url, refresh_ahead=True)
                 if idx == True: self.worker()
 
             if idx == True and create_directory == True: self.movieDirectory(self.list)
+
+            if self.deferred:
+                self.list, pending = self.deferred
+                self.deferred = None
+                self.enrich(pending)
+                if self.meta: progressive.refresh()
+
             return self.list
         except:
             pass
@@ -459,6 +472,7 @@ class movies:
             result = client.request(url)
 
             result = result.replace('\n', ' ')
+            result = dom_index.ParsedDocument(result)
 
             items = client.parseDOM(result, 'div', attrs = {'class': 'lister-item .+?'})
             items += client.parseDOM(result, 'div', attrs = {'class': 'list_item.+?'})
@@ -641,14 +655,14 @@ class movies:
 
         self.list = metacache.fetch(self.list, self.lang, self.user)
 
-        for r in range(0, total, 40):
-            threads = []
-            for i in range(r, r+40):
-                if i <= total: threads.append(workers.Thread(self.super_info, i))
-            [i.start() for i in threads]
-            [i.join() for i in threads]
+        pending = [i for i in range(0, total) if not self.list[i]['metacache'] == True]
 
-            if self.meta: metacache.insert(self.meta)
+        if pending and self.progressive and not progressive.refreshed():
+            # list what the metacache had, get() enriches the rest once the directory is out
+            self.deferred = (self.list, pending)
+            self.list = [dict(i) for i in self.list]
+        else:
+            self.enrich(pending)
 
         self.list = [i for i in self.list if not i['imdb'] == '0']
 
@@ -657,51 +671,66 @@ class movies:
         if self.fanart_tv_user == '':
             for i in self.list: i.update({'clearlogo': '0', 'clearart': '0'})
 
+    def enrich(self, pending):
+        writer = metacache.Writer(self.meta)
+        workers.pool.map(self.super_info, pending, timeout=30, callback=writer.flush)
+        writer.close()
+
     def super_info(self, i):
         try:
             if self.list[i]['metacache'] == True: raise Exception()
 
             imdb = self.list[i]['imdb']
 
-            item = trakt.getMovieSummary(imdb)
+            if 'premiered' in self.list[i]:
+                # trakt_list asks for extended=full, its items already carry what the summary has
+                title, year, tmdb, premiered, genre, duration, rating, votes, mpaa, tagline, plot = [self.list[i].get(k, '0') for k in ('title', 'year', 'tmdb', 'premiered', 'genre', 'duration', 'rating', 'votes', 'mpaa', 'tagline', 'plot')]
+                translations = None
+            else:
+                item = trakt.getMovieSummary(imdb)
+                if not item:
+                    self.meta.append({'imdb': imdb, 'tmdb': '0', 'tvdb': '0', 'lang': self.lang, 'user': self.user, 'item': {}})
+                    raise Exception()
+
+                title = item.get('title')
+                title = client.replaceHTMLCodes(title)
 
-            title = item.get('title')
-            title = client.replaceHTMLCodes(title)
+                year = item.get('year', 0)
+                year = re.sub('[^0-9]', '', str(year))
 
-            originaltitle = title
+                imdb = item.get('ids', {}).get('imdb', '0')
+                imdb = 'tt' + re.sub('[^0-9]', '', str(imdb))
 
-            year = item.get('year', 0)
-            year = re.sub('[^0-9]', '', str(year))
+                tmdb = str(item.get('ids', {}).get('tmdb', 0))
 
-            imdb = item.get('ids', {}).get('imdb', '0')
-            imdb = 'tt' + re.sub('[^0-9]', '', str(imdb))
+                premiered = item.get('released', '0')
+                try: premiered = re.compile('(\d{4}-\d{2}-\d{2})').findall(premiered)[0]
+                except: premiered = '0'
 
-            tmdb = str(item.get('ids', {}).get('tmdb', 0))
+                genre = item.get('genres', [])
+                genre = [x.title() for x in genre]
+                genre = ' / '.join(genre).strip()
+                if not genre: genre = '0'
 
-            premiered = item.get('released', '0')
-            try: premiered = re.compile('(\d{4}-\d{2}-\d{2})').findall(premiered)[0]
-            except: premiered = '0'
+                duration = str(item.get('Runtime', 0))
 
-            genre = item.get('genres', [])
-            genre = [x.title() for x in genre]
-            genre = ' / '.join(genre).strip()
-            if not genre: genre = '0'
+                rating = item.get('rating', '0')
+                if not rating or rating == '0.0': rating = '0'
 
-            duration = str(item.get('Runtime', 0))
+                votes = item.get('votes', '0')
+                try: votes = str(format(int(votes), ',d'))
+                except: pass
 
-            rating = item.get('rating', '0')
-            if not rating or rating == '0.0': rating = '0'
+                mpaa = item.get('certification', '0')
+                if not mpaa: mpaa = '0'
 
-            votes = item.get('votes', '0')
-            try: votes = str(format(int(votes), ',d'))
-            except: pass
+                tagline = item.get('tagline', '0')
 
-            mpaa = item.get('certification', '0')
-            if not mpaa: mpaa = '0'
+                plot = item.get('overview', '0')
 
-            tagline = item.get('tagline', '0')
+                translations = item.get('available_translations', [self.lang])
 
-            plot = item.get('overview', '0')
+            originaltitle = title
 
             people = trakt.getPeople(imdb, 'movies')
 
@@ -717,7 +746,7 @@ class movies:
             cast = [(person['name'], person['role']) for person in cast]
 
             try:
-                if self.lang == 'en' or self.lang not in item.get('available_translations', [self.lang]): raise Exception()
+                if self.lang == 'en' or (translations and self.lang not in translations): raise Exception()
 
                 trans_item = trakt.getMovieTranslation(imdb, self.lang, full=True)
 
@@ -805,7 +834,10 @@ class movies:
 
             item = {'title': title, 'originaltitle': originaltitle, 'year': year, 'imdb': imdb, 'tmdb': tmdb, 'poster': '0', 'poster2': poster2, 'poster3': poster3, 'banner': banner, 'fanart': fanart, 'fanart2': fanart2, 'clearlogo': clearlogo, 'clearart': clearart, 'premiered': premiered, 'genre': genre, 'duration': duration, 'rating': rating, 'votes': votes, 'mpaa': mpaa, 'director': director, 'writer': writer, 'cast': cast, 'plot': plot, 'tagline': tagline}
             item = dict((k,v) for k, v in item.iteritems() if not v == '0')
-            self.list[i].update(item)
+            with workers.pool.result() as current:
+                # too late, the list is already being listed
+                if not current: raise Exception()
+                self.list[i].update(item)
 
             if artmeta == False: raise Exception()
 
@@ -962,7 +994,7 @@ class movies:
             pass
 
         control.content(syshandle, 'movies')
-        control.directory(syshandle, cacheToDisc=True)
+        control.directory(syshandle, cacheToDisc=not self.deferred)
         views.setView('movies', {'skin.estuary': 55, 'skin.confluence': 500})
 
     def addDirectory(self, items, queue=False):
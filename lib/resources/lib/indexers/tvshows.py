@@ -20,9 +20,12 @@ from resources.lib.modules import cleantitle
 from resources.lib.modules import cleangenre
 from resources.lib.modules import control
 from resources.lib.modules import client
+from resources.lib.modules import dom_index
 from resources.lib.modules import cache
+from resources.lib.modules import ids
 from resources.lib.modules import metacache
 from resources.lib.modules import playcount
+from resources.lib.modules import progressive
 from resources.lib.modules import workers
 from resources.lib.modules import views
 from resources.lib.modules import utils
@@ -37,6 +40,8 @@ action = params.get('action')
 class tvshows:
     def __init__(self):
         self.list = []
+        self.deferred = None
+        self.progressive = False
         self.imdb_link = 'http://www.imdb.com'
         self.trakt_link = 'http://api.trakt.tv'
         self.tvmaze_link = 'http://www.tvmaze.com'
@@ -56,8 +61,6 @@ class tvshows:
         self.tvdb_info_link = 'https://thetvdb.com/api/%s/series/%s/%s.xml' % (self.tvdb_key, '%s', self.lang)
         self.fanart_tv_art_link = 'https://webservice.fanart.tv/v3/tv/%s'
         self.fanart_tv_level_link = 'https://webservice.fanart.tv/v3/level'
-        self.tvdb_by_imdb = 'https://thetvdb.com/api/GetSeriesByRemoteID.php?imdbid=%s'
-        self.tvdb_by_query = 'https://thetvdb.com/api/GetSeries.php?seriesname=%s'
         self.tvdb_image = 'https://thetvdb.com/banners/'
 
         self.persons_link = 'https://www.imdb.com/search/name?count=100&name='
@@ -91,6 +94,8 @@ class tvshows:
 
     def get(self, url, idx=True, create_directory=True):
         try:
+            self.progressive = idx == True and create_directory == True and progressive.enabled()
+
             try: url = getattr(self, url + '_link')
             except: pass
 
@@ -102,9 +107,9 @@ class tvshows:
                 try:
                     if not '/users/me/' in url: raise Exception()
                     if trakt.getActivity() > cache.timeout(self.trakt_list, url, self.trakt_user): raise Exception()
-                    self.list = cache.get(self.trakt_list, 720, url, self.trakt_user)
+                    self.list = cache.get(self.trakt_list, 720, url, self.trakt_user, tags=[trakt.userCacheTag()])
                 except:
-                    self.list = cache.get(self.trakt_list, 0, url, self.trakt_user)
+                    self.list = cache.get(self.trakt_list, 0, url, self.trakt_user, tags=[trakt.userCacheTag()])
 
                 if '/users/me/' in url and '/collection/' in url:
                     self.list = sorted(self.list, key=lambda k: utils.title_key(k['title']))
@@ -116,7 +121,7 @@ class tvshows:
                 if idx == True: self.worker(level=0)
 
             elif u in self.trakt_link:
-                self.list = cache.get(self.trakt_list, 24, url, self.trakt_user)
+                self.list = cache.get(tvshows().trakt_list, 24, url, self.trakt_user, refresh_ahead=True)
                 if idx == True: self.worker()
 
 
@@ -125,15 +130,22 @@ class tvshows:
                 if idx == True: self.worker()
 
             elif u in self.imdb_link:
-                self.list = cache.get(self.imdb_list, 24, url)
+                self.list = cache.get(tvshows().imdb_list, 24, url, refresh_ahead=True)
                 if idx == True: self.worker()
 
 
             elif u in self.tvmaze_link:
-                self.list = cache.get(self.tvmaze_list, 168, url)
+                self.list = cache.get(tvshows().tvmaze_list, 168, url, refresh_ahead=True)
                 if idx == True: self.worker()
 
             if idx == True and create_directory == True: self.tvshowDirectory(self.list)
+
+            if self.deferred:
+                self.list, pending = self.deferred
+                self.deferred = None
+                self.enrich(pending)
+                if self.meta: progressive.refresh()
+
             return self.list
         except:
             pass
@@ -520,6 +532,7 @@ class tvshows:
             result = client.request(url)
 
             result = result.replace('\n', ' ')
+            result = dom_index.ParsedDocument(result)
 
             items = client.parseDOM(result, 'div', attrs = {'class': 'lister-item .+?'})
             items += client.parseDOM(result, 'div', attrs = {'class': 'list_item.+?'})
@@ -770,22 +783,33 @@ class tvshows:
 
         for i in range(0, total): self.list[i].update({'metacache': False})
 
+        # ids found for earlier listings let the metacache match items that came without a tvdb id
+        ids.shows(self.list, resolve=False)
+
         self.list = metacache.fetch(self.list, self.lang, self.user)
 
-        for r in range(0, total, 40):
-            threads = []
-            for i in range(r, r+40):
-                if i <= total: threads.append(workers.Thread(self.super_info, i))
-            [i.start() for i in threads]
-            [i.join() for i in threads]
+        pending = [i for i in range(0, total) if not self.list[i]['metacache'] == True]
+
+        # super_info finds the tvdb id of items that came without one, a first paint would leave them out
+        missing = [i for i in pending if self.list[i].get('tvdb', '0') == '0']
 
-            if self.meta: metacache.insert(self.meta)
+        if pending and not missing and self.progressive and not progressive.refreshed():
+            # list what the metacache had, get() enriches the rest once the directory is out
+            self.deferred = (self.list, pending)
+            self.list = [dict(i) for i in self.list]
+        else:
+            self.enrich(pending)
 
         self.list = [i for i in self.list if not i['tvdb'] == '0']
 
         if self.fanart_tv_user == '':
             for i in self.list: i.update({'clearlogo': '0', 'clearart': '0'})
 
+    def enrich(self, pending):
+        writer = metacache.Writer(self.meta)
+        workers.pool.map(self.super_info, pending, timeout=30, callback=writer.flush)
+        writer.close()
+
     def super_info(self, i):
         try:
             if self.list[i]['metacache'] == True: raise Exception()
@@ -793,52 +817,13 @@ class tvshows:
             imdb = self.list[i]['imdb'] if 'imdb' in self.list[i] else '0'
             tvdb = self.list[i]['tvdb'] if 'tvdb' in self.list[i] else '0'
 
-            if imdb == '0':
-                try:
-                    imdb = trakt.SearchTVShow(urllib.quote_plus(self.list[i]['title']), self.list[i]['year'], full=False)[0]
-                    imdb = imdb.get('show', '0')
-                    imdb = imdb.get('ids', {}).get('imdb', '0')
-                    imdb = 'tt' + re.sub('[^0-9]', '', str(imdb))
-
-                    if not imdb: imdb = '0'
-                except:
-                    imdb = '0'
-
-            if tvdb == '0' and not imdb == '0':
-                url = self.tvdb_by_imdb % imdb
-
-                result = client.request(url, timeout='10')
-
-                try: tvdb = client.parseDOM(result, 'seriesid')[0]
-                except: tvdb = '0'
-
-                try: name = client.parseDOM(result, 'SeriesName')[0]
-                except: name = '0'
-                dupe = re.findall('[***]Duplicate (\d*)[***]', name)
-                if dupe: tvdb = str(dupe[0])
-
-                if tvdb == '': tvdb = '0'
-
-            if tvdb == '0':
-                url = self.tvdb_by_query % (urllib.quote_plus(self.list[i]['title']))
-
-                years = [str(self.list[i]['year']), str(int(self.list[i]['year'])+1), str(int(self.list[i]['year'])-1)]
-
-                tvdb = client.request(url, timeout='10')
-                tvdb = re.sub(r'[^\x00-\x7F]+', '', tvdb)
-                tvdb = client.replaceHTMLCodes(tvdb)
-                tvdb = client.parseDOM(tvdb, 'Series')
-                tvdb = [(x, client.parseDOM(x, 'SeriesName'), client.parseDOM(x, 'FirstAired')) for x in tvdb]
-                tvdb = [(x, x[1][0], x[2][0]) for x in tvdb if len(x[1]) > 0 and len(x[2]) > 0]
-                tvdb = [x for x in tvdb if cleantitle.get(self.list[i]['title']) == cleantitle.get(x[1])]
-                tvdb = [x[0][0] for x in tvdb if any(y in x[2] for y in years)][0]
-                tvdb = client.parseDOM(tvdb, 'seriesid')[0]
-
-                if tvdb == '': tvdb = '0'
+            imdb, tvdb = ids.show(imdb, tvdb, self.list[i]['title'], self.list[i]['year'])
 
             url = self.tvdb_info_link % tvdb
             item = client.request(url, timeout='10')
-            if item == None: raise Exception()
+            if item == None:
+                self.meta.append({'imdb': imdb, 'tvdb': tvdb, 'lang': self.lang, 'user': self.user, 'item': {}})
+                raise Exception()
 
             if imdb == '0':
                 try: imdb = client.parseDOM(item, 'IMDB_ID')[0]
@@ -991,7 +976,10 @@ class tvshows:
 
             item = {'title': title, 'year': year, 'imdb': imdb, 'tvdb': tvdb, 'poster': poster, 'poster2': poster2, 'banner': banner, 'banner2': banner2, 'fanart': fanart, 'fanart2': fanart2, 'clearlogo': clearlogo, 'clearart': clearart, 'premiered': premiered, 'studio': studio, 'genre': genre, 'duration': duration, 'rating': rating, 'votes': votes, 'mpaa': mpaa, 'cast': cast, 'plot': plot}
             item = dict((k,v) for k, v in item.iteritems() if not v == '0')
-            self.list[i].update(item)
+            with workers.pool.result() as current:
+                # too late, the list is already being listed
+                if not current: raise Exception()
+                self.list[i].update(item)
 
             if artmeta == False: raise Exception()
 
@@ -1152,7 +1140,7 @@ class tvshows:
             pass
 
         control.content(syshandle, 'tvshows')
-        control.directory(syshandle, cacheToDisc=True)
+        control.directory(syshandle, cacheToDisc=not self.deferred)
         views.setView('tvshows', {'skin.estuary': 55, 'skin.confluence': 500})
 
     def addDirectory(self, items, queue=False):
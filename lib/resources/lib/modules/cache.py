@@ -15,11 +15,20 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import ast
+import copy
 import hashlib
+import marshal
+import os
 import re
+import threading
 import time
+import types
+from collections import OrderedDict
+from contextlib import contextmanager
+from resources.lib.modules import cache_codec
+from resources.lib.modules import cache_metrics
 from resources.lib.modules import control
+from resources.lib.modules import workers
 
 try:
     from sqlite3 import dbapi2 as db, OperationalError
@@ -31,46 +40,249 @@ This module is used to get/set cache for every action done in the system
 """
 
 cache_table = 'cache'
+tags_table = 'cache_tags'
+# schema version of each database file once its tables were checked, another process
+# dropping them (cache_clear) changes it and the tables are created again
+_tables_ready = {}
+
+# Namespaces a function name can start with, e.g. trakt_list is kept under 'trakt'.
+# Other functions are kept under the last part of their module name, e.g. 'client'.
+namespaces = ('trakt', 'imdb', 'tvdb', 'tmdb', 'tvmaze', 'fanart')
+
+# Pragmas every connection is opened with, WAL lets readers and a writer work side by side
+# and with synchronous=NORMAL it only syncs on checkpoints instead of on every commit
+connection_pragmas = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', '-2000'),
+    ('temp_store', 'MEMORY')
+)
+busy_timeout = 10
+
+# Connections are kept per thread and per database for the life of the process
+_local = threading.local()
+
+# Bounds of the in-process tier in front of the cache table
+memory_max_items = 500
+memory_max_bytes = 4 * 1024 * 1024
+
+# Hours past its duration an entry may still be served by get(..., refresh_ahead=True)
+max_stale_hours = 72
+
+# Minutes a failed lookup is remembered before it is tried again,
+# the plugin can override it with the cache.negative_ttl setting
+negative_ttl_minutes = 15
+
+# Budget maintenance() trims the cache table to, least recently used rows go first.
+# The plugin can override them with the cache.max_rows and cache.max_mb settings.
+max_rows = 5000
+max_mb = 50
+# Rows nobody read for this many days are dropped whatever the budget
+max_idle_days = 30
+# Hours between two maintenance runs
+maintenance_interval = 24
+# Seconds an access time may lag behind, so reads only write once in a while
+access_resolution = 24 * 3600
+
+
+class _MemoryCache(object):
+    """
+    Bounded LRU of recently used cache rows, consulted before the SQLite table.
+    Values are held marshalled, so a hit costs a marshal.loads instead of a query and a decode,
+    and every caller still gets its own copy to mutate.
+    """
 
+    def __init__(self, max_items, max_bytes):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
 
-def get(function, duration, *args):
+    def get(self, key):
+        # type: (str) -> (int, object) or None
+        with self._lock:
+            try:
+                date, blob = self._items.pop(key)
+            except KeyError:
+                return None
+            self._items[key] = (date, blob)
+        return date, marshal.loads(blob)
+
+    def set(self, key, value, date):
+        # type: (str, object, int) -> None
+        try:
+            blob = marshal.dumps(value)
+        except ValueError:
+            return
+        if len(blob) > self.max_bytes:
+            return self.remove(key)
+
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old:
+                self._bytes -= len(old[1])
+            self._items[key] = (date, blob)
+            self._bytes += len(blob)
+            while len(self._items) > self.max_items or self._bytes > self.max_bytes:
+                self._bytes -= len(self._items.popitem(last=False)[1][1])
+
+    def remove(self, key):
+        # type: (str) -> None
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old:
+                self._bytes -= len(old[1])
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+
+_memory = _MemoryCache(memory_max_items, memory_max_bytes)
+
+
+def get(function, duration, *args, **kwargs):
     # type: (function, int, object) -> object or None
     """
     Gets cached value for provided function with optional arguments, or executes and stores the result
     :param function: Function to be executed
     :param duration: Duration of validity of cache in hours
     :param args: Optional arguments for the provided function
+    :param refresh_ahead: Keyword only. Return an expired value right away and refresh it in the background
+    :param max_stale: Keyword only. Hours past duration an expired value may still be returned, max_stale_hours if omitted
+    :param namespace: Keyword only. Namespace the value is stored under, derived from the function if omitted
+    :param tags: Keyword only. Tags the value can be invalidated by with invalidate_tag()
     """
 
     try:
         key = _hash_function(function, args)
+        store = (kwargs.get('namespace') or _get_namespace(function), kwargs.get('tags'))
+        memory_result = _memory.get(key)
+        if memory_result and _is_cache_valid(memory_result[0], duration):
+            _record(key, 'hits')
+            _record(key, 'memory_hits')
+            return memory_result[1]
+
         cache_result = cache_get(key)
         if cache_result:
+            _touch(key, cache_result)
             if _is_cache_valid(cache_result['date'], duration):
-                return ast.literal_eval(cache_result['value'].encode('utf-8'))
-
-        fresh_result = repr(function(*args))
-        if not fresh_result:
+                result = cache_codec.decode(cache_result.get('format'), cache_result['value'])
+                _memory.set(key, result, cache_result['date'])
+                _record(key, 'hits')
+                return result
+
+            if _is_recent_failure(cache_result.get('failed')):
+                # the function failed a moment ago, don't call it again yet
+                _record(key, 'negative')
+                return _decode_stale(cache_result)
+
+            max_stale = kwargs.get('max_stale', max_stale_hours)
+            if kwargs.get('refresh_ahead') and _is_cache_valid(cache_result['date'], duration + max_stale):
+                result = cache_codec.decode(cache_result.get('format'), cache_result['value'])
+                _memory.set(key, result, cache_result['date'])
+                _refresh(key, function, args, store)
+                _record(key, 'stale')
+                return result
+
+        flight, leader = workers.board(key)
+
+        if not leader:
+            _record(key, 'shared')
+            flight.done.wait()
+            if not flight.completed:
+                # the leader failed, fall back to the old cache just like it does
+                return _decode_stale(cache_result) if cache_result else None
+            # a copy of its own, callers extend and mutate what they get
+            memory_result = _memory.get(key)
+            return memory_result[1] if memory_result else _copy(flight.result)
+
+        result = _fly(key, flight, function, args, store)
+        if result is None and cache_result:
             # If the cache is old, but we didn't get fresh result, return the old cache
-            if cache_result:
-                return cache_result
+            return _decode_stale(cache_result)
+        return result
+    except Exception:
+        return None
+
+
+def _fly(key, flight, function, args, store):
+    try:
+        start = time.time()
+        try:
+            fresh_result = function(*args)
+        except Exception:
+            fresh_result = None
+        if fresh_result is None:
+            cache_failure(key, store[0])
+            _record(key, 'failures', time.time() - start)
             return None
 
-        cache_insert(key, fresh_result)
-        return ast.literal_eval(fresh_result.encode('utf-8'))
+        flight.result = fresh_result
+        flight.completed = True
+        seconds = time.time() - start
+        size = cache_insert(key, fresh_result, *store)
+        _memory.set(key, fresh_result, int(time.time()))
+        _record(key, 'misses', seconds, size)
+        return fresh_result
+    finally:
+        workers.land(key, flight)
+
+
+def _copy(value):
+    try:
+        return marshal.loads(marshal.dumps(value))
+    except ValueError:
+        return copy.deepcopy(value)
+
+
+def _refresh(key, function, args, store):
+    """
+    Recomputes key on a worker thread unless it is already being computed.
+    The thread is not a daemon, so the interpreter lets it finish before the plugin run ends.
+    """
+    flight, leader = workers.board(key, join=False)
+    if not leader:
+        return
+    workers.Thread(_refresh_worker, key, flight, function, args, store).start()
+
+
+def _refresh_worker(key, flight, function, args, store):
+    try:
+        _fly(key, flight, function, args, store)
     except Exception:
-        return None
+        pass
 
 
 def timeout(function, *args):
     try:
         key = _hash_function(function, args)
+        memory_result = _memory.get(key)
+        if memory_result:
+            return int(memory_result[0])
         result = cache_get(key)
         return int(result['date'])
     except Exception:
         return None
 
 
+def remove(function, *args):
+    # type: (function, object) -> None
+    """
+    Removes the cached value for provided function and arguments from both tiers
+    """
+    try:
+        key = _hash_function(function, args)
+        _memory.remove(key)
+        cursor = _get_connection_cursor()
+        cursor.execute("DELETE FROM %s WHERE key = ?" % cache_table, [key])
+        commit(cursor.connection)
+    except Exception:
+        pass
+
+
 def cache_get(key):
     # type: (str, str) -> dict or None
     try:
@@ -81,32 +293,329 @@ def cache_get(key):
         return None
 
 
-def cache_insert(key, value):
-    # type: (str, str) -> None
+def cache_insert(key, value, namespace=None, tags=None):
+    # type: (str, object, str, list) -> int
     cursor = _get_connection_cursor()
     now = int(time.time())
-    cursor.execute(
-        "CREATE TABLE IF NOT EXISTS %s (key TEXT, value TEXT, date INTEGER, UNIQUE(key))"
-        % cache_table
-    )
+    _create_table(cursor)
+    fmt, data = cache_codec.encode(value)
     update_result = cursor.execute(
-        "UPDATE %s SET value=?,date=? WHERE key=?"
-        % cache_table, (value, now, key))
+        "UPDATE %s SET value=?,date=?,format=?,accessed=?,namespace=?,failed=NULL WHERE key=?"
+        % cache_table, (data, now, fmt, now, namespace, key))
 
     if update_result.rowcount is 0:
         cursor.execute(
-            "INSERT INTO %s Values (?, ?, ?)"
-            % cache_table, (key, value, now)
+            "INSERT INTO %s (key, value, date, format, accessed, namespace) Values (?, ?, ?, ?, ?, ?)"
+            % cache_table, (key, data, now, fmt, now, namespace)
         )
 
-    cursor.connection.commit()
+    if tags:
+        cursor.executemany(
+            "INSERT OR IGNORE INTO %s Values (?, ?)" % tags_table, [(tag, key) for tag in tags])
+
+    commit(cursor.connection)
+    return len(data)
+
+
+def _record(key, event, seconds=None, size=None):
+    # metrics are kept per function, key is 'v2:<qualified name>:<md5>'
+    try:
+        cache_metrics.record(key[len(key_version):key.rindex(':')], event, seconds, size)
+    except Exception:
+        pass
+
+
+def cache_failure(key, namespace=None):
+    # type: (str, str) -> None
+    """
+    Records that computing key failed, an older value stored for it is kept
+    """
+    try:
+        cursor = _get_connection_cursor()
+        now = int(time.time())
+        _create_table(cursor)
+        update_result = cursor.execute(
+            "UPDATE %s SET failed=? WHERE key=?" % cache_table, (now, key))
+        if update_result.rowcount is 0:
+            cursor.execute(
+                "INSERT INTO %s (key, date, accessed, namespace, failed) Values (?, ?, ?, ?, ?)"
+                % cache_table, (key, 0, now, namespace, now)
+            )
+        commit(cursor.connection)
+    except Exception:
+        pass
+
+
+def negative_ttl():
+    # type: () -> int
+    """Seconds a failed lookup is remembered for, metacache uses the same for failed metadata lookups"""
+    try: return int(control.setting('cache.negative_ttl')) * 60
+    except: return negative_ttl_minutes * 60
+
+
+def _is_recent_failure(failed):
+    return bool(failed) and int(time.time()) - failed < negative_ttl()
+
+
+def _decode_stale(row):
+    if row['value'] is None:
+        return None
+    return cache_codec.decode(row.get('format'), row['value'])
+
+
+def get_many(namespace, keys, duration):
+    # type: (str, list, int) -> dict
+    """
+    Gets the values stored with set_many() that are still valid, in one query
+    :param namespace: Namespace the values were stored under
+    :param keys: Keys to look up
+    :param duration: Duration of validity of cache in hours
+    :return: {key: value} for every key that was found and is valid
+    """
+    results = {}
+    missing = {}
+    for key in keys:
+        stored_key = _namespaced_key(namespace, key)
+        memory_result = _memory.get(stored_key)
+        if memory_result and _is_cache_valid(memory_result[0], duration):
+            results[key] = memory_result[1]
+        else:
+            missing[stored_key] = key
+
+    try:
+        cursor = _get_connection_cursor()
+        stored_keys = list(missing)
+        # stay below SQLITE_MAX_VARIABLE_NUMBER
+        for i in range(0, len(stored_keys), 500):
+            chunk = stored_keys[i:i + 500]
+            cursor.execute(
+                "SELECT * FROM %s WHERE key IN (%s)" % (cache_table, ','.join('?' * len(chunk))), chunk)
+            for row in cursor.fetchall():
+                if row['value'] is None or not _is_cache_valid(row['date'], duration):
+                    continue
+                value = cache_codec.decode(row.get('format'), row['value'])
+                _memory.set(row['key'], value, row['date'])
+                results[missing[row['key']]] = value
+    except OperationalError:
+        pass
+    return results
+
+
+def set_many(namespace, items, tags=None):
+    # type: (str, dict, list) -> None
+    """
+    Stores several values in one transaction
+    :param namespace: Namespace to store the values under
+    :param items: {key: value} to store
+    :param tags: Tags every value can be invalidated by with invalidate_tag()
+    """
+    cursor = _get_connection_cursor()
+    now = int(time.time())
+    _create_table(cursor)
+    rows = []
+    for key, value in items.iteritems():
+        stored_key = _namespaced_key(namespace, key)
+        fmt, data = cache_codec.encode(value)
+        rows.append((stored_key, data, now, fmt, now, namespace))
+        _memory.set(stored_key, value, now)
+
+    with batch():
+        cursor.executemany(
+            "INSERT OR REPLACE INTO %s (key, value, date, format, accessed, namespace) Values (?, ?, ?, ?, ?, ?)"
+            % cache_table, rows)
+        if tags:
+            cursor.executemany(
+                "INSERT OR IGNORE INTO %s Values (?, ?)" % tags_table, [(tag, row[0]) for tag in tags for row in rows])
+
+
+def invalidate_tag(tag):
+    # type: (str) -> None
+    """
+    Removes every value stored with the given tag, e.g. 'trakt.user:<user>' after the user's history changed
+    """
+    try:
+        cursor = _get_connection_cursor()
+        cursor.execute("SELECT key FROM %s WHERE tag = ?" % tags_table, [tag])
+        keys = [row['key'] for row in cursor.fetchall()]
+        _delete(cursor, keys)
+        commit(cursor.connection)
+    except OperationalError:
+        pass
+
+
+def invalidate_namespace(namespace):
+    # type: (str) -> None
+    """
+    Removes every value stored under the given namespace
+    """
+    try:
+        cursor = _get_connection_cursor()
+        cursor.execute("SELECT key FROM %s WHERE namespace = ?" % cache_table, [namespace])
+        keys = [row['key'] for row in cursor.fetchall()]
+        _delete(cursor, keys)
+        commit(cursor.connection)
+    except OperationalError:
+        pass
+
+
+def _delete(cursor, keys):
+    rows = [(key,) for key in keys]
+    cursor.executemany("DELETE FROM %s WHERE key = ?" % cache_table, rows)
+    cursor.executemany("DELETE FROM %s WHERE key = ?" % tags_table, rows)
+    for key in keys:
+        _memory.remove(key)
+
+
+def _namespaced_key(namespace, key):
+    return '%s%s/%s' % (key_version, namespace, key)
+
+
+def _create_table(cursor):
+    version = cursor.execute("PRAGMA schema_version").fetchone()['schema_version']
+    if _tables_ready.get(control.cacheFile) == version:
+        return
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS %s (key TEXT, value TEXT, date INTEGER, format TEXT, accessed INTEGER, namespace TEXT, failed INTEGER, UNIQUE(key))"
+        % cache_table
+    )
+    # tables created before rows carried their format, those rows read as repr
+    columns = [column['name'] for column in cursor.execute("PRAGMA table_info(%s)" % cache_table).fetchall()]
+    if 'format' not in columns:
+        cursor.execute("ALTER TABLE %s ADD COLUMN format TEXT" % cache_table)
+    if 'accessed' not in columns:
+        cursor.execute("ALTER TABLE %s ADD COLUMN accessed INTEGER" % cache_table)
+    if 'namespace' not in columns:
+        cursor.execute("ALTER TABLE %s ADD COLUMN namespace TEXT" % cache_table)
+    if 'failed' not in columns:
+        cursor.execute("ALTER TABLE %s ADD COLUMN failed INTEGER" % cache_table)
+    cursor.execute("CREATE INDEX IF NOT EXISTS %s_namespace ON %s (namespace)" % (cache_table, cache_table))
+    cursor.execute("CREATE TABLE IF NOT EXISTS %s (tag TEXT, key TEXT, UNIQUE(tag, key))" % tags_table)
+    cursor.execute("CREATE INDEX IF NOT EXISTS %s_key ON %s (key)" % (tags_table, tags_table))
+    # rows keyed by older schemes can never be hit again
+    if cursor.execute("PRAGMA user_version").fetchone()['user_version'] < 2:
+        cursor.execute("DELETE FROM %s WHERE substr(key, 1, ?) != ?" % cache_table, (len(key_version), key_version))
+        cursor.execute("PRAGMA user_version=2")
+        cursor.connection.commit()
+    _tables_ready[control.cacheFile] = cursor.execute("PRAGMA schema_version").fetchone()['schema_version']
+
+
+def _touch(key, row):
+    # access times only need to be good enough to tell recently used rows from forgotten ones
+    now = int(time.time())
+    if (row.get('accessed') or row['date']) > now - access_resolution:
+        return
+    try:
+        cursor = _get_connection_cursor()
+        _create_table(cursor)
+        cursor.execute("UPDATE %s SET accessed=? WHERE key=?" % cache_table, (now, key))
+        commit(cursor.connection)
+    except Exception:
+        pass
+
+
+def maintenance(force=False):
+    """
+    Trims the cache table to its budget and returns the freed pages to the file system.
+    Runs at most once every maintenance_interval hours unless forced, so a service can call it freely.
+    Meant for the service loop or a worker thread, it can take a while on a large table.
+    """
+    stamp = os.path.join(control.dataPath, 'cache.m')
+    now = int(time.time())
+    if not force:
+        try:
+            with open(stamp, 'rb') as fh: last = int(fh.read())
+        except: last = 0
+        if now - last < maintenance_interval * 3600:
+            return
+    try:
+        with open(stamp, 'wb') as fh: fh.write(str(now))
+    except: pass
+
+    try:
+        cursor = _get_connection_cursor()
+        _create_table(cursor)
+        evict(cursor, now)
+        compact(cursor)
+    except Exception:
+        pass
+
+
+def evict(cursor, now=None):
+    """
+    Deletes rows idle for more than max_idle_days, then least recently used rows until the table is within budget
+    :return: Number of rows deleted
+    """
+    now = now or int(time.time())
+    try: rows_budget = int(control.setting('cache.max_rows'))
+    except: rows_budget = max_rows
+    try: bytes_budget = int(control.setting('cache.max_mb')) * 1024 * 1024
+    except: bytes_budget = max_mb * 1024 * 1024
+
+    cursor.execute(
+        "SELECT key, length(value) AS size FROM %s ORDER BY coalesce(accessed, date) DESC"
+        % cache_table)
+    rows = cursor.fetchall()
+
+    cursor.execute(
+        "SELECT key FROM %s WHERE coalesce(accessed, date) < ?"
+        % cache_table, [now - max_idle_days * 86400])
+    doomed = set(row['key'] for row in cursor.fetchall())
+
+    kept = total = 0
+    for row in rows:
+        if row['key'] in doomed:
+            continue
+        kept += 1
+        total += row['size'] or 0
+        if kept > rows_budget or total > bytes_budget:
+            doomed.add(row['key'])
+
+    if doomed:
+        _delete(cursor, doomed)
+        cursor.connection.commit()
+    return len(doomed)
+
+
+def compact(cursor):
+    """
+    Releases free pages with an incremental vacuum, switching the database to incremental
+    auto_vacuum with one full VACUUM the first time
+    """
+    conn = cursor.connection
+    conn.commit()
+    if cursor.execute("PRAGMA auto_vacuum").fetchone()['auto_vacuum'] != 2:
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cursor.execute("VACUUM")
+    else:
+        cursor.execute("PRAGMA incremental_vacuum")
+        cursor.fetchall()
+    try:
+        cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        cursor.fetchall()
+    except Exception:
+        pass
+
+
+def codec_benchmark(limit=10, rounds=5):
+    """
+    Runs cache_codec.benchmark on the largest values currently in the cache table
+    :param limit: Number of rows to sample
+    :param rounds: Number of times each value is encoded and decoded per format
+    """
+    cursor = _get_connection_cursor()
+    cursor.execute(
+        "SELECT * FROM %s WHERE value IS NOT NULL ORDER BY length(value) DESC LIMIT ?" % cache_table, [limit])
+    values = [cache_codec.decode(row.get('format'), row['value']) for row in cursor.fetchall()]
+    return cache_codec.benchmark(values, rounds)
 
 
 def cache_clear():
+    _memory.clear()
+    _tables_ready.pop(control.cacheFile, None)
     try:
         cursor = _get_connection_cursor()
 
-        for t in [cache_table, 'rel_list', 'rel_lib']:
+        for t in [cache_table, tags_table, 'rel_list', 'rel_lib']:
             try:
                 cursor.execute("DROP TABLE IF EXISTS %s" % t)
                 cursor.execute("VACUUM")
@@ -121,7 +630,7 @@ def cache_clear_meta():
     try:
         cursor = _get_connection_cursor_meta()
 
-        for t in ['meta']:
+        for t in ['meta', 'tvdb', 'ids']:
             try:
                 cursor.execute("DROP TABLE IF EXISTS %s" % t)
                 cursor.execute("VACUUM")
@@ -168,52 +677,87 @@ def cache_clear_all():
     cache_clear_providers()
 
 
+@contextmanager
+def batch():
+    """
+    Defers the commits of cache writes made by this thread until the block exits,
+    so a run of inserts costs one transaction instead of one per insert.
+    Blocks nest, the outermost one commits.
+    """
+    _local.batch = getattr(_local, 'batch', 0) + 1
+    try:
+        yield
+    finally:
+        _local.batch -= 1
+        if not _local.batch:
+            for conn in getattr(_local, 'connections', {}).values():
+                try:
+                    conn.commit()
+                except Exception:
+                    pass
+
+
+def commit(conn):
+    """Commits conn unless this thread is inside a batch()"""
+    if not getattr(_local, 'batch', 0):
+        conn.commit()
+
+
+def connect(path):
+    """The connection of this thread to the database at path, opened and configured on first use"""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(path)
+    if conn is None:
+        control.makeFile(control.dataPath)
+        conn = db.connect(path, timeout=busy_timeout)
+        for pragma, value in connection_pragmas:
+            try:
+                conn.execute("PRAGMA %s=%s" % (pragma, value))
+            except Exception:
+                pass
+        connections[path] = conn
+    return conn
+
+
+def _cursor(conn):
+    cursor = conn.cursor()
+    cursor.row_factory = _dict_factory
+    return cursor
+
+
 def _get_connection_cursor():
-    conn = _get_connection()
-    return conn.cursor()
+    return _cursor(_get_connection())
 
 
 def _get_connection():
-    control.makeFile(control.dataPath)
-    conn = db.connect(control.cacheFile)
-    conn.row_factory = _dict_factory
-    return conn
+    return connect(control.cacheFile)
 
 
 def _get_connection_cursor_meta():
-    conn = _get_connection_meta()
-    return conn.cursor()
+    return _cursor(_get_connection_meta())
 
 
 def _get_connection_meta():
-    control.makeFile(control.dataPath)
-    conn = db.connect(control.metacacheFile)
-    conn.row_factory = _dict_factory
-    return conn
+    return connect(control.metacacheFile)
 
 
 def _get_connection_cursor_providers():
-    conn = _get_connection_providers()
-    return conn.cursor()
+    return _cursor(_get_connection_providers())
 
 
 def _get_connection_providers():
-    control.makeFile(control.dataPath)
-    conn = db.connect(control.providercacheFile)
-    conn.row_factory = _dict_factory
-    return conn
+    return connect(control.providercacheFile)
 
 
 def _get_connection_cursor_search():
-    conn = _get_connection_search()
-    return conn.cursor()
+    return _cursor(_get_connection_search())
 
 
 def _get_connection_search():
-    control.makeFile(control.dataPath)
-    conn = db.connect(control.searchFile)
-    conn.row_factory = _dict_factory
-    return conn
+    return connect(control.searchFile)
 
 
 def _dict_factory(cursor, row):
@@ -223,20 +767,111 @@ def _dict_factory(cursor, row):
     return d
 
 
-def _hash_function(function_instance, *args):
+def _hash_function(function_instance, args):
     return _get_function_name(function_instance) + _generate_md5(args)
 
 
-def _get_function_name(function_instance):
-    return re.sub('.+\smethod\s|.+function\s|\sat\s.+|\sof\s.+', '', repr(function_instance))
+# Prefix of every key, rows with any other key predate the current scheme
+key_version = 'v2:'
+_function_names = {}
 
 
-def _generate_md5(*args):
+def _get_function_name(function_instance):
+    """
+    The qualified name of a function, e.g. 'v2:resources.lib.indexers.movies.movies.trakt_list:',
+    so methods of the same name on different classes or modules get different keys
+    """
+    owner = getattr(function_instance, 'im_self', None)
+    if owner is not None and not isinstance(owner, (type, types.ClassType)):
+        owner = owner.__class__
+    # keyed on where the code was defined rather than on the function object,
+    # so closures and lambdas created on every call share one entry
+    code = getattr(getattr(function_instance, 'im_func', function_instance), 'func_code', None)
+    memo_key = None
+    if code is not None:
+        memo_key = (getattr(function_instance, '__module__', None), owner.__name__ if owner else None,
+                    code.co_name, code.co_firstlineno)
+        try:
+            return _function_names[memo_key]
+        except KeyError:
+            pass
+
+    name = getattr(function_instance, '__name__', None)
+    module = getattr(function_instance, '__module__', None)
+    if name and module:
+        parts = [module, owner.__name__, name] if owner else [module, name]
+        qualified = key_version + '.'.join(parts) + ':'
+    else:
+        qualified = key_version + re.sub('.+\smethod\s|.+function\s|\sat\s.+|\sof\s.+', '', repr(function_instance)) + ':'
+
+    if memo_key is not None:
+        _function_names[memo_key] = qualified
+    return qualified
+
+
+def _get_namespace(function_instance):
+    name = getattr(function_instance, '__name__', '')
+    prefix = name.split('_', 1)[0]
+    if prefix in namespaces:
+        return prefix
+    module = getattr(function_instance, '__module__', None) or ''
+    return module.rsplit('.', 1)[-1] or None
+
+
+def _generate_md5(args):
     md5_hash = hashlib.md5()
-    [md5_hash.update(str(arg)) for arg in args]
+    _encode_arg(args, md5_hash.update)
     return str(md5_hash.hexdigest())
 
 
+def _encode_arg(arg, write):
+    """
+    Writes an unambiguous, type tagged encoding of arg, dicts and sets in sorted order.
+    str and unicode holding the same text encode the same, as they did with str(args).
+    """
+    if isinstance(arg, basestring):
+        if isinstance(arg, unicode):
+            arg = arg.encode('utf-8')
+        write('s%d:' % len(arg))
+        write(arg)
+    elif arg is None or isinstance(arg, bool):
+        write('%r;' % arg)
+    elif isinstance(arg, (int, long)):
+        write('i%d;' % arg)
+    elif isinstance(arg, float):
+        write('f%r;' % arg)
+    elif isinstance(arg, (list, tuple)):
+        write('%s%d[' % ('l' if isinstance(arg, list) else 't', len(arg)))
+        for item in arg:
+            _encode_arg(item, write)
+        write(']')
+    elif isinstance(arg, dict):
+        items = []
+        for k, v in arg.iteritems():
+            parts = []
+            _encode_arg(k, parts.append)
+            _encode_arg(v, parts.append)
+            items.append(''.join(parts))
+        write('d%d{' % len(items))
+        for item in sorted(items):
+            write(item)
+        write('}')
+    elif isinstance(arg, (set, frozenset)):
+        items = []
+        for item in arg:
+            parts = []
+            _encode_arg(item, parts.append)
+            items.append(''.join(parts))
+        write('e%d{' % len(items))
+        for item in sorted(items):
+            write(item)
+        write('}')
+    else:
+        value = repr(arg)
+        write('r%d:' % len(value))
+        write(value)
+
+
 def _is_cache_valid(cached_time, cache_timeout):
     now = int(time.time())
     diff = now - cached_time
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Exodus Redux Add-on
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import ast
+import cPickle
+import json
+import marshal
+import time
+import zlib
+
+"""
+Serialization of cache rows.
+
+Every row carries the name of the format it was written in, so the codec used for new
+rows can change without invalidating what is already stored.  Rows written before the
+format column existed have no format and are read as 'repr'.
+
+A format is a codec name, optionally followed by '+zlib' when the payload was large
+enough to be compressed before it was stored.
+"""
+
+DEFAULT = 'marshal'
+
+# payloads at least this large are compressed
+COMPRESS_MIN = 4096
+COMPRESS_LEVEL = 1
+
+LEGACY = 'repr'
+ZLIB = '+zlib'
+
+
+def _repr_loads(data):
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return ast.literal_eval(data)
+
+
+def _json_dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+CODECS = {
+    'repr': (repr, _repr_loads),
+    'json': (_json_dumps, json.loads),
+    'marshal': (lambda value: marshal.dumps(value, 2), marshal.loads),
+    'pickle': (lambda value: cPickle.dumps(value, 2), cPickle.loads)
+}
+
+# codecs that produce text, which is stored as TEXT to stay readable in the database
+TEXT = frozenset(['repr', 'json'])
+
+
+def encode(value, codec=None):
+    # type: (object, str) -> (str, object)
+    """
+    Serializes a value for storage
+    :param value: Value to serialize
+    :param codec: Name of one of the CODECS, DEFAULT if omitted
+    :return: (format, data) where data is ready to be bound to a sqlite parameter
+    """
+    codec = codec or DEFAULT
+    try:
+        data = CODECS[codec][0](value)
+    except (ValueError, TypeError):
+        # not every value survives every codec, repr is what cache has always used
+        codec = LEGACY
+        data = repr(value)
+
+    if len(data) >= COMPRESS_MIN:
+        packed = zlib.compress(data, COMPRESS_LEVEL)
+        if len(packed) < len(data):
+            return codec + ZLIB, buffer(packed)
+
+    if codec in TEXT:
+        return codec, data
+    return codec, buffer(data)
+
+
+def decode(fmt, data):
+    # type: (str, object) -> object
+    """
+    Deserializes a stored value
+    :param fmt: Format the row was written in, None for rows older than the format column
+    :param data: Stored value as returned by sqlite
+    """
+    fmt = fmt or LEGACY
+    if isinstance(data, buffer):
+        data = str(data)
+    if fmt.endswith(ZLIB):
+        fmt = fmt[:-len(ZLIB)]
+        data = zlib.decompress(data)
+    return CODECS[fmt][1](data)
+
+
+def benchmark(values, rounds=5):
+    """
+    Times every codec, with and without compression, on the given values
+    :param values: Payloads to measure, e.g. cached indexer lists
+    :param rounds: Number of times each payload is encoded and decoded
+    :return: {format: {'encode': seconds, 'decode': seconds, 'size': bytes}} summed over all values
+    """
+    results = {}
+    for codec in sorted(CODECS):
+        dumps, loads = CODECS[codec]
+        for compress in (False, True):
+            fmt = codec + ZLIB if compress else codec
+            result = results[fmt] = {'encode': 0.0, 'decode': 0.0, 'size': 0}
+            for value in values:
+                start = time.time()
+                for i in range(rounds):
+                    data = dumps(value)
+                    if compress:
+                        data = zlib.compress(data, COMPRESS_LEVEL)
+                result['encode'] += (time.time() - start) / rounds
+
+                start = time.time()
+                for i in range(rounds):
+                    loads(zlib.decompress(data) if compress else data)
+                result['decode'] += (time.time() - start) / rounds
+
+                result['size'] += len(data)
+    return results
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Exodus Redux Add-on
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from resources.lib.modules import control
+
+"""
+Counters kept by cache.get for every cached function.
+
+Events are counted in memory and added to cache_metrics.json in the profile directory
+every FLUSH_EVERY events, FLUSH_SECONDS after the last write and once a listing is out
+(control.directory), so the numbers add up across plugin runs.  Plugin runs merge into
+the file under cache_metrics.json.lock, a run that can't get it keeps its counters for
+the next flush.  Set the plugin's cache.metrics setting to false to turn counting off.
+
+report() has no menu entry in this module, the plugin's router would have to show it.
+"""
+
+EVENTS = ('hits', 'memory_hits', 'misses', 'stale', 'negative', 'shared', 'failures')
+
+# upper bounds in seconds of the compute time histogram, the last bucket takes the rest
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+FLUSH_EVERY = 100
+FLUSH_SECONDS = 60
+# seconds a flush waits for the file lock, and after which a lock is taken as left by a crashed run
+LOCK_WAIT = 2
+LOCK_STALE = 30
+
+_metrics = {}
+_pending = [0]
+_flushed = [time.time()]
+_lock = threading.Lock()
+_file_lock = threading.Lock()
+_enabled = []
+
+
+def enabled():
+    if not _enabled:
+        try: _enabled.append(not control.setting('cache.metrics') == 'false')
+        except: _enabled.append(True)
+    return _enabled[0]
+
+
+def record(name, event, seconds=None, size=None):
+    """
+    Counts one event for a function
+    :param name: Qualified name of the cached function
+    :param event: One of EVENTS
+    :param seconds: Time the function took to compute, for misses
+    :param size: Size in bytes of the stored value, for misses
+    """
+    if not enabled():
+        return
+    with _lock:
+        entry = _metrics.get(name)
+        if entry is None:
+            entry = _metrics[name] = _new_entry()
+        entry[event] += 1
+        if seconds is not None:
+            entry['compute_time'] += seconds
+            entry['latency'][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        if size is not None:
+            entry['size'] = size
+            entry['max_size'] = max(entry['max_size'], size)
+        _pending[0] += 1
+        flush_now = _pending[0] >= FLUSH_EVERY or time.time() - _flushed[0] >= FLUSH_SECONDS
+    if flush_now:
+        flush()
+
+
+def flush():
+    """Adds the counters of this process to the JSON dump and resets them"""
+    with _lock:
+        if not _metrics:
+            return
+        counted = dict(_metrics)
+        _metrics.clear()
+        _pending[0] = 0
+        _flushed[0] = time.time()
+
+    with _file_lock, _locked() as locked:
+        if locked:
+            stored = _load()
+            for name, entry in counted.iteritems():
+                stored[name] = _merge(stored.get(name) or _new_entry(), entry)
+            try:
+                _write(stored)
+                return
+            except Exception:
+                pass
+
+    # keep them for the next flush
+    with _lock:
+        for name, entry in counted.iteritems():
+            _metrics[name] = _merge(_metrics.get(name) or _new_entry(), entry)
+
+
+def metrics():
+    """
+    Counters of every cached function, those of this process included
+    :return: {name: {event: count, 'compute_time': seconds, 'latency': [count per bucket], 'size': bytes, 'max_size': bytes}}
+    """
+    flush()
+    with _file_lock:
+        return _load()
+
+
+def report():
+    """metrics() as text, busiest functions first"""
+    lines = []
+    stored = metrics()
+    names = sorted(stored, key=lambda name: -(stored[name]['hits'] + stored[name]['misses']))
+    for name in names:
+        entry = stored[name]
+        lookups = entry['hits'] + entry['misses']
+        hit_rate = 100.0 * entry['hits'] / lookups if lookups else 0.0
+        computed = entry['misses'] + entry['failures']
+        average = entry['compute_time'] / computed if computed else 0.0
+        lines.append('[B]%s[/B]' % name)
+        lines.append('  hits %d (memory %d)  misses %d  hit rate %.0f%%' % (entry['hits'], entry['memory_hits'], entry['misses'], hit_rate))
+        lines.append('  stale %d  negative %d  shared %d  failures %d' % (entry['stale'], entry['negative'], entry['shared'], entry['failures']))
+        lines.append('  compute avg %.2fs  p50 %s  p95 %s  size %d bytes (max %d)' % (
+            average, _percentile(entry['latency'], 0.5), _percentile(entry['latency'], 0.95), entry['size'], entry['max_size']))
+    return '\n'.join(lines)
+
+
+def clear():
+    with _lock:
+        _metrics.clear()
+        _pending[0] = 0
+    with _file_lock, _locked():
+        try: os.remove(_path())
+        except: pass
+
+
+def _new_entry():
+    entry = dict((event, 0) for event in EVENTS)
+    entry.update({'compute_time': 0.0, 'latency': [0] * (len(LATENCY_BUCKETS) + 1), 'size': 0, 'max_size': 0})
+    return entry
+
+
+def _merge(stored, entry):
+    for event in EVENTS:
+        stored[event] = stored.get(event, 0) + entry[event]
+    stored['compute_time'] = stored.get('compute_time', 0.0) + entry['compute_time']
+    latency = stored.get('latency') or []
+    stored['latency'] = [(latency[i] if i < len(latency) else 0) + count for i, count in enumerate(entry['latency'])]
+    if entry['size']:
+        stored['size'] = entry['size']
+    stored['max_size'] = max(stored.get('max_size', 0), entry['max_size'])
+    return stored
+
+
+def _percentile(latency, fraction):
+    total = sum(latency)
+    if not total:
+        return '-'
+    seen = 0
+    for i, count in enumerate(latency):
+        seen += count
+        if seen >= total * fraction:
+            return '<%ss' % LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else '>%ss' % LATENCY_BUCKETS[-1]
+
+
+def _load():
+    try:
+        with open(_path(), 'rb') as fh: return json.load(fh)
+    except Exception:
+        return {}
+
+
+@contextmanager
+def _locked():
+    # plugin runs are separate interpreters, only a file keeps them from merging at the same time
+    path = _path() + '.lock'
+    deadline = time.time() + LOCK_WAIT
+    while True:
+        try:
+            control.makeFile(control.dataPath)
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except (OSError, IOError):
+            try:
+                if time.time() - os.path.getmtime(path) > LOCK_STALE:
+                    os.remove(path)
+                    continue
+            except (OSError, IOError):
+                pass
+            if time.time() > deadline:
+                yield False
+                return
+            time.sleep(0.05)
+    try:
+        yield True
+    finally:
+        try: os.remove(path)
+        except: pass
+
+
+def _write(stored):
+    # another plugin run may be reading or writing the dump, so it is replaced whole
+    control.makeFile(control.dataPath)
+    handle, temp = tempfile.mkstemp(prefix='cache_metrics.', dir=control.dataPath)
+    try:
+        with os.fdopen(handle, 'wb') as fh: json.dump(stored, fh, indent=1, sort_keys=True)
+        try:
+            os.rename(temp, _path())
+        except OSError:
+            # windows doesn't rename over an existing file
+            os.remove(_path())
+            os.rename(temp, _path())
+    except Exception:
+        try: os.remove(temp)
+        except: pass
+        raise
+
+
+def _path():
+    return os.path.join(control.dataPath, 'cache_metrics.json')
+
+
+atexit.register(flush)
@@ -19,7 +19,10 @@
 
 import re, sys, cookielib, urllib, urllib2, urlparse, gzip, StringIO, HTMLParser, time, random, base64
 
-from resources.lib.modules import cache, dom_parser, log_utils, utils, control
+from resources.lib.modules import cache, dom_parser, dom_patterns, keepalive, log_utils, utils, control, workers
+
+_ssl_contexts = {}
+_https_handlers = {}
 
 
 def request(
@@ -27,6 +30,8 @@ def request(
         XHR=False, limit=None, referer=None, cookie=None, compression=True, output='', timeout='20'
 ):
 
+    response = None
+
     try:
         if not url:
             return
@@ -38,12 +43,6 @@ def request(
             opener = urllib2.build_opener(*handlers)
             urllib2.install_opener(opener)
 
-        if output == 'cookie' or output == 'extended' or not close is True:
-            cookies = cookielib.LWPCookieJar()
-            handlers += [urllib2.HTTPHandler(), urllib2.HTTPSHandler(), urllib2.HTTPCookieProcessor(cookies)]
-            opener = urllib2.build_opener(*handlers)
-            urllib2.install_opener(opener)
-
         try:
             import platform
             node = platform.node().lower()
@@ -53,26 +52,25 @@ def request(
             is_XBOX = False
 
         if verify is False and sys.version_info >= (2, 7, 12):
-            try:
-                import ssl
-                ssl_context = ssl._create_unverified_context()
-                handlers += [urllib2.HTTPSHandler(context=ssl_context)]
-                opener = urllib2.build_opener(*handlers)
-                urllib2.install_opener(opener)
-            except:
-                pass
+            ssl_mode = 'unverified'
+        elif verify is True and ((2, 7, 8) < sys.version_info < (2, 7, 12) or is_XBOX):
+            ssl_mode = 'nocheck'
+        else:
+            ssl_mode = 'default'
 
-        if verify is True and ((2, 7, 8) < sys.version_info < (2, 7, 12) or is_XBOX):
-            try:
-                import ssl
-                ssl_context = ssl.create_default_context()
-                ssl_context.check_hostname = False
-                ssl_context.verify_mode = ssl.CERT_NONE
-                handlers += [urllib2.HTTPSHandler(context=ssl_context)]
-                opener = urllib2.build_opener(*handlers)
-                urllib2.install_opener(opener)
-            except:
-                pass
+        # responses left open by the caller would pin a pooled connection
+        https_handler = _get_https_handler(ssl_mode, pooled=close is True)
+
+        if output == 'cookie' or output == 'extended' or not close is True:
+            cookies = cookielib.LWPCookieJar()
+            handlers += [urllib2.HTTPHandler(), https_handler, urllib2.HTTPCookieProcessor(cookies)]
+            opener = urllib2.build_opener(*handlers)
+            urllib2.install_opener(opener)
+
+        if not https_handler in handlers:
+            handlers += [https_handler]
+            opener = urllib2.build_opener(*handlers)
+            urllib2.install_opener(opener)
 
         if url.startswith('//'): url = 'http:' + url
 
@@ -86,9 +84,9 @@ def request(
         if 'User-Agent' in _headers:
             pass
         elif mobile is True:
-            _headers['User-Agent'] = cache.get(randommobileagent, 1)
+            _headers['User-Agent'] = cache.get(randommobileagent, 1, namespace='agent')
         else:
-            _headers['User-Agent'] = cache.get(randomagent, 1)
+            _headers['User-Agent'] = cache.get(randomagent, 1, namespace='agent')
 
         if 'Referer' in _headers:
             pass
@@ -122,7 +120,7 @@ def request(
                 http_error_303 = http_error_302
                 http_error_307 = http_error_302
 
-            opener = urllib2.build_opener(NoRedirectHandler())
+            opener = urllib2.build_opener(*(handlers + [NoRedirectHandler()]))
             urllib2.install_opener(opener)
 
             try:
@@ -140,7 +138,7 @@ def request(
         _add_request_header(request, _headers)
 
         try:
-            response = urllib2.urlopen(request, timeout=int(timeout))
+            response = _urlopen(request, timeout)
         except urllib2.HTTPError as response:
             if response.code == 503:
                 cf_result = response.read()
@@ -162,8 +160,9 @@ def request(
                         request = urllib2.Request(url, data=post)
                         _add_request_header(request, _headers)
 
+                        _close(response)
                         try:
-                            response = urllib2.urlopen(request, timeout=int(timeout))
+                            response = _urlopen(request, timeout)
                             cf_result = 'Success'
                         except urllib2.HTTPError as response:
                             cache.remove(cfcookie().get, netloc, ua, timeout)
@@ -171,10 +170,12 @@ def request(
                 else:
                     log_utils.log('Request-Error (%s): %s' % (str(response.code), url), log_utils.LOGDEBUG)
                     if error is False:
+                        if close is True: _close(response)
                         return
             else:
                 log_utils.log('Request-Error (%s): %s' % (str(response.code), url), log_utils.LOGDEBUG)
                 if error is False:
+                    if close is True: _close(response)
                     return
 
         if output == 'cookie':
@@ -205,7 +206,9 @@ def request(
                 content = int(response.headers['Content-Length'])
             except:
                 content = (2049 * 1024)
-            if content < (2048 * 1024): return
+            if content < (2048 * 1024):
+                if close is True: response.close()
+                return
             result = response.read(16 * 1024)
             if close is True: response.close()
             return result
@@ -240,7 +243,8 @@ def request(
             request = urllib2.Request(url, data=post)
             _add_request_header(request, _headers)
 
-            response = urllib2.urlopen(request, timeout=int(timeout))
+            _close(response)
+            response = _urlopen(request, timeout)
 
             if limit == '0':
                 result = response.read(224 * 1024)
@@ -283,10 +287,71 @@ def request(
             if close is True: response.close()
             return result
     except Exception as e:
+        if close is True: _close(response)
         log_utils.log('Request-Error: (%s) => %s' % (str(e), url), log_utils.LOGDEBUG)
         return
 
 
+def _urlopen(request, timeout):
+    # the worker pool adapts its concurrency to how long remote requests take
+    start = time.time()
+    try:
+        return urllib2.urlopen(request, timeout=int(timeout))
+    finally:
+        workers.observe(time.time() - start)
+
+
+def _close(response):
+    # an unclosed keepalive response keeps its pooled connection busy
+    try:
+        response.close()
+    except Exception:
+        pass
+
+
+def _get_ssl_context(mode):
+    """
+    Returns the SSL context for a verification mode, created once per process and shared by every request.
+    'default' verifies certificates, 'unverified' skips verification and 'nocheck' keeps the default
+    context but disables hostname and certificate checks (old 2.7 builds and XBOX).
+    """
+    try:
+        return _ssl_contexts[mode]
+    except KeyError:
+        pass
+
+    try:
+        import ssl
+        if mode == 'default':
+            ssl_context = keepalive.shared_ssl_context()
+        elif mode == 'unverified':
+            ssl_context = ssl._create_unverified_context()
+        else:
+            ssl_context = ssl.create_default_context()
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+        # session tickets let a reconnect to the same host skip the full handshake
+        ssl_context.options &= ~getattr(ssl, 'OP_NO_TICKET', 0)
+    except Exception:
+        ssl_context = None
+
+    return _ssl_contexts.setdefault(mode, ssl_context)
+
+
+def _get_https_handler(mode, pooled=True):
+    ssl_context = _get_ssl_context(mode)
+
+    if ssl_context is None:
+        return urllib2.HTTPSHandler()
+    if not pooled:
+        return urllib2.HTTPSHandler(context=ssl_context)
+
+    try:
+        return _https_handlers[mode]
+    except KeyError:
+        return _https_handlers.setdefault(mode, keepalive.HTTPSHandler(context=ssl_context))
+
+
 def _basic_request(url, headers=None, post=None, timeout='30', limit=None):
     try:
         try:
@@ -296,7 +361,7 @@ def _basic_request(url, headers=None, post=None, timeout='30', limit=None):
 
         request = urllib2.Request(url, data=post)
         _add_request_header(request, headers)
-        response = urllib2.urlopen(request, timeout=int(timeout))
+        response = _urlopen(request, timeout)
         return _get_result(response, limit)
     except:
         return
@@ -343,7 +408,7 @@ def parseDOM(html, name='', attrs=None, ret=False):
 
     if attrs:
 
-        attrs = dict((key, re.compile(value + ('$' if value else ''))) for key, value in attrs.iteritems())
+        attrs = dict((key, dom_patterns.value(value)) for key, value in attrs.iteritems())
 
     results = dom_parser.parse_dom(html, name, attrs, ret)
 
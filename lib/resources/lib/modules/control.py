@@ -46,7 +46,6 @@ addItem = xbmcplugin.addDirectoryItem
 
 item = xbmcgui.ListItem
 
-directory = xbmcplugin.endOfDirectory
 
 content = xbmcplugin.setContent
 
@@ -79,6 +78,16 @@ getCurrentDialogId = xbmcgui.getCurrentWindowDialogId()
 keyboard = xbmc.Keyboard
 
 # Modified `sleep` command that honors a user exit request
+def directory(handle, *args, **kwargs):
+    xbmcplugin.endOfDirectory(handle, *args, **kwargs)
+    # the listing is out and the plugin run about to end, keep its cache counters
+    try:
+        from resources.lib.modules import cache_metrics
+        cache_metrics.flush()
+    except:
+        pass
+
+
 def sleep (time):
     while time > 0 and not xbmc.abortRequested:
         xbmc.sleep(min(100, time))
@@ -0,0 +1,278 @@
+"""
+   Tag index backend for dom_parser / dom_parser2
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+from bisect import bisect_left
+
+re_type = type(re.compile(''))
+
+# what \s matches in the regex backend (no re.UNICODE)
+WHITESPACE = frozenset(' \t\n\r\f\v')
+NAME_END = WHITESPACE | frozenset('/>')
+
+# names and keys that are used as plain text; anything else could be a regex
+# fragment in the regex backend, so those queries are left to it
+_plain = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-:')
+
+
+def supports(name, attrs):
+    if not name or not set(name) <= _plain: return False
+    for key, value in attrs.iteritems():
+        if not key or not set(key) <= _plain: return False
+        if not isinstance(value, (re_type, basestring, list, tuple, set)): return False
+    return True
+
+
+class DomIndex(object):
+    """
+    Answers parse_dom element queries for one document without regex scans.
+
+    The document is lower-cased once, every '<name' start position is then found
+    with str.find and kept per tag name, and the offsets of literal open/close tag
+    strings used to match end tags are kept sorted, so each of them is only
+    searched for once however many queries are made.
+
+    Matching replicates the regex backend, quirks included: attribute queries match
+    tag names by prefix, the right-most occurrence of an attribute wins and an
+    unquoted value is only considered when no quoted value matched anywhere.
+
+    Queries take a lo/hi window and then behave exactly as if they were run on
+    html[lo:hi], which is how a ParsedDocument searches inside a match.
+    """
+
+    def __init__(self, html):
+        self.html = html
+        self.lower = html.lower()
+        self._tags = {}
+        self._offsets = {}
+
+    def tags(self, name):
+        """(start, name_end) of every '<name' in the document, name_end is where the tag name stops"""
+        name = name.lower()
+        try:
+            return self._tags[name]
+        except KeyError:
+            pass
+
+        html, lower = self.html, self.lower
+        needle = '<' + name
+        size = len(html)
+        tags = []
+        start = lower.find(needle)
+        while start != -1:
+            end = start + len(needle)
+            while end < size and html[end] not in NAME_END: end += 1
+            tags.append((start, end))
+            start = lower.find(needle, start + 1)
+
+        self._tags[name] = tags
+        return tags
+
+    def _window_tags(self, name, lo, hi):
+        # tags starting inside html[lo:hi], with name_end and the first '>' clipped to the window
+        tags = self.tags(name)
+        html = self.html
+        i = bisect_left(tags, (lo,))
+        last = hi - len(name) - 1
+        while i < len(tags) and tags[i][0] <= last:
+            start, end = tags[i]
+            yield start, min(end, hi), html.find('>', start + 1, hi)
+            i += 1
+
+    def find(self, needle, start, hi=None):
+        """same as html.find(needle, start, hi) for start >= 0, answered from a cached offset list"""
+        try:
+            offsets = self._offsets[needle]
+        except KeyError:
+            offsets = []
+            pos = self.html.find(needle)
+            while pos != -1:
+                offsets.append(pos)
+                pos = self.html.find(needle, pos + 1)
+            self._offsets[needle] = offsets
+
+        i = bisect_left(offsets, start)
+        if i == len(offsets): return -1
+        if hi is not None and offsets[i] + len(needle) > hi: return -1
+        return offsets[i]
+
+    def elements(self, name, attrs, slash_ends_value=False, lo=0, hi=None):
+        if hi is None: hi = len(self.html)
+        if not attrs:
+            return self._plain_elements(name, lo, hi)
+
+        last_list = None
+        for key, value in attrs.iteritems():
+            value_is_regex = isinstance(value, re_type)
+            value_is_str = isinstance(value, basestring)
+
+            if value_is_regex:
+                this_list = [r[0] for r in self._key_elements(name, key, True, lo, hi) if re.match(value, r[1])]
+            else:
+                temp_value = set([value] if value_is_str else value)
+                this_list = [r[0] for r in self._key_elements(name, key, True, lo, hi) if temp_value <= set(r[1].split(' '))]
+
+            if not this_list:
+                has_space = (value_is_regex and ' ' in value.pattern) or (value_is_str and ' ' in value)
+                if not has_space:
+                    re_list = self._key_elements(name, key, False, lo, hi, slash_ends_value)
+                    if value_is_regex:
+                        this_list = [r[0] for r in re_list if re.match(value, r[1])]
+                    else:
+                        this_list = [r[0] for r in re_list if value == r[1]]
+
+            if last_list is None:
+                last_list = this_list
+            else:
+                last_set = set(last_list)
+                last_list = [item for item in this_list if item in last_set]
+
+        return last_list
+
+    def _plain_elements(self, name, lo, hi):
+        html = self.html
+        tag_end = len(name) + 1
+        results = []
+        last = lo
+        for start, end, close in self._window_tags(name, lo, hi):
+            if start < last or close == -1 or not end == start + tag_end: continue
+            c = html[end] if end < hi else ''
+            if c in WHITESPACE or c == '>' or (c == '/' and end + 1 < hi and html[end + 1] == '>'):
+                results.append(html[start:close + 1])
+                last = close + 1
+        return results
+
+    def _key_elements(self, name, key, quoted, lo, hi, slash_ends_value=False):
+        html, lower = self.html, self.lower
+        needle = key.lower() + '='
+        offset = len(name) + 1
+        results = []
+        last = lo
+        for start, end, close in self._window_tags(name, lo, hi):
+            if start < last or close == -1: continue
+            k = lower.rfind(needle, start + offset + 1, close)
+            while k != -1:
+                if html[k - 1] in WHITESPACE:
+                    vs = k + len(needle)
+                    if quoted:
+                        delim = html[vs]
+                        if delim == '"' or delim == "'":
+                            q = html.find(delim, vs + 1, hi)
+                            g = html.find('>', q + 1, hi) if q != -1 else -1
+                            if g != -1:
+                                results.append((html[start:g + 1], html[vs + 1:q]))
+                                last = g + 1
+                                break
+                    else:
+                        ve = vs
+                        while ve < hi and html[ve] not in WHITESPACE and not html[ve] == '>':
+                            if slash_ends_value and html[ve] == '/': break
+                            ve += 1
+                        results.append((html[start:close + 1], html[vs:ve]))
+                        last = close + 1
+                        break
+                k = lower.rfind(needle, start + offset + 1, k + len(needle) - 1)
+        return results
+
+    def content_range(self, match, name, base=0, hi=None):
+        """
+        (start, end) of the content of element <match>, searched for from offset <base>
+        the way dom_parser.__get_dom_content does, or None if it has no content
+        """
+        if hi is None: hi = len(self.html)
+        if match.endswith('/>'): return None
+
+        # override tag name with tag from match if possible
+        end = 1
+        while end < len(match) and match[end] not in NAME_END: end += 1
+        if end > 1: name = match[1:end]
+
+        start_str = '<%s' % name
+        end_str = "</%s" % name
+
+        start = self.html.find(match, base, hi)
+        if start == -1: return None
+        end = self.find(end_str, start, hi)
+        pos = self.find(start_str, start + 1, hi)
+
+        while pos < end and pos != -1:  # Ignore too early </endstr> return
+            tend = self.find(end_str, end + len(end_str), hi)
+            if tend != -1:
+                end = tend
+            pos = self.find(start_str, pos + 1, hi)
+
+        if end > -1:
+            return start + len(match), end
+        return start + len(match), hi
+
+    def content(self, match, name, base=0, hi=None):
+        r = self.content_range(match, name, base, hi)
+        return self.html[r[0]:r[1]] if r else ''
+
+    def strip_range(self, start, end):
+        """the range of html[start:end].strip()"""
+        html = self.html
+        while start < end and html[start].isspace(): start += 1
+        while end > start and html[end - 1].isspace(): end -= 1
+        return start, end
+
+    def advance(self, match, content, base, hi=None):
+        """offset parse_dom continues from after a match, mirrors item = item[item.find(content, item.find(match)):]"""
+        if hi is None: hi = len(self.html)
+        html = self.html
+        pos = html.find(match, base, hi)
+        if pos == -1: pos = max(hi - 1, base)
+        pos = html.find(content, pos, hi)
+        if pos == -1: return max(hi - 1, base)
+        return pos
+
+
+class ParsedDocument(object):
+    """
+    A document decoded and indexed once for repeated parse_dom / client.parseDOM queries.
+
+    Pass it wherever html is accepted.  Matches returned for it remember their place in
+    the document, so querying a match searches that range of the same index instead of
+    decoding and scanning a copy of its content.
+    """
+
+    def __init__(self, html, start=0, end=None, index=None):
+        if index is None:
+            index = DomIndex(_decode(html))
+        self.index = index
+        self.html = index.html
+        self.start = start
+        self.end = len(self.html) if end is None else end
+
+    @property
+    def content(self):
+        return self.html[self.start:self.end]
+
+    def within(self, start, end):
+        return ParsedDocument(None, start, end, self.index)
+
+
+def _decode(html):
+    if isinstance(html, str):
+        try:
+            return html.decode("utf-8")
+        except:
+            try:
+                return html.decode("utf-8", "replace")
+            except:
+                return html
+    return html
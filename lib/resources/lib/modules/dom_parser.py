@@ -19,15 +19,30 @@
 import re
 from collections import namedtuple
 
+from resources.lib.modules import dom_index
+from resources.lib.modules import dom_patterns
+
 DomMatch = namedtuple('DOMMatch', ['attrs', 'content'])
 re_type = type(re.compile(''))
+comment_re = re.compile('<!--.*?-->', re.DOTALL)
+tag_re = re.compile('<([^\s/>]+)')
+attrib_re = re.compile('''\s+(?P<key>[^=]+)=\s*(?:(?P<delim>["'])(?P<value1>.*?)(?P=delim)|(?P<value2>[^"'][^>\s]*))''')
+
+# 'regex' runs one regex scan per attribute over the document, 'index' answers
+# the same queries from a dom_index.DomIndex built for the document
+BACKEND = 'regex'
+
+
+class DocumentMatch(DomMatch):
+    """DomMatch from a dom_index.ParsedDocument, .document is its content as a ParsedDocument"""
+    document = None
 
 
 def __get_dom_content(html, name, match):
     if match.endswith('/>'): return ''
 
     # override tag name with tag from match if possible
-    tag = re.match('<([^\s/>]+)', match)
+    tag = tag_re.match(match)
     if tag: name = tag.group(1)
 
     start_str = '<%s' % name
@@ -60,15 +75,13 @@ def __get_dom_content(html, name, match):
 
 def __get_dom_elements(item, name, attrs):
     if not attrs:
-        pattern = '(<%s(?:\s[^>]*>|/?>))' % name
-        this_list = re.findall(pattern, item, re.M | re.S | re.I)
+        this_list = dom_patterns.get(name).findall(item)
     else:
         last_list = None
         for key, value in attrs.iteritems():
             value_is_regex = isinstance(value, re_type)
             value_is_str = isinstance(value, basestring)
-            pattern = '''(<{tag}[^>]*\s{key}=(?P<delim>['"])(.*?)(?P=delim)[^>]*>)'''.format(tag=name, key=key)
-            re_list = re.findall(pattern, item, re.M | re.S | re.I)
+            re_list = dom_patterns.get(name, key, 'quoted').findall(item)
             if value_is_regex:
                 this_list = [r[0] for r in re_list if re.match(value, r[2])]
             else:
@@ -78,8 +91,7 @@ def __get_dom_elements(item, name, attrs):
             if not this_list:
                 has_space = (value_is_regex and ' ' in value.pattern) or (value_is_str and ' ' in value)
                 if not has_space:
-                    pattern = '''(<{tag}[^>]*\s{key}=((?:[^\s>]|/>)*)[^>]*>)'''.format(tag=name, key=key)
-                    re_list = re.findall(pattern, item, re.M | re.S | re.I)
+                    re_list = dom_patterns.get(name, key, 'unquoted').findall(item)
                     if value_is_regex:
                         this_list = [r[0] for r in re_list if re.match(value, r[1])]
                     else:
@@ -96,7 +108,7 @@ def __get_dom_elements(item, name, attrs):
 
 def __get_attribs(element):
     attribs = {}
-    for match in re.finditer('''\s+(?P<key>[^=]+)=\s*(?:(?P<delim>["'])(?P<value1>.*?)(?P=delim)|(?P<value2>[^"'][^>\s]*))''', element):
+    for match in attrib_re.finditer(element):
         match = match.groupdict()
         value1 = match.get('value1')
         value2 = match.get('value2')
@@ -106,10 +118,34 @@ def __get_attribs(element):
     return attribs
 
 
-def parse_dom(html, name='', attrs=None, req=False, exclude_comments=False):
+def __get_indexed_results(item, name, attrs, req):
+    # a ParsedDocument gets matches that can be queried again without copying
+    chained = isinstance(item, dom_index.ParsedDocument)
+    if chained: document = item
+    else: document = dom_index.ParsedDocument(item)
+    index, base, hi = document.index, document.start, document.end
+
+    results = []
+    for element in index.elements(name, attrs, lo=base, hi=hi):
+        attribs = __get_attribs(element)
+        if req and not req <= set(attribs.keys()): continue
+        content = index.content_range(element, name, base, hi)
+        content = index.strip_range(*content) if content else (base, base)
+        temp = index.html[content[0]:content[1]]
+        if chained:
+            match = DocumentMatch(attribs, temp)
+            match.document = document.within(*content)
+        else:
+            match = DomMatch(attribs, temp)
+        results.append(match)
+        base = index.advance(element, temp, base, hi)
+    return results
+
+
+def parse_dom(html, name='', attrs=None, req=False, exclude_comments=False, backend=None):
     if attrs is None: attrs = {}
     name = name.strip()
-    if isinstance(html, unicode) or isinstance(html, DomMatch):
+    if isinstance(html, unicode) or isinstance(html, DomMatch) or isinstance(html, dom_index.ParsedDocument):
         html = [html]
     elif isinstance(html, str):
         try:
@@ -133,13 +169,27 @@ def parse_dom(html, name='', attrs=None, req=False, exclude_comments=False):
             req = [req]
         req = set([key.lower() for key in req])
 
+    if backend is None: backend = BACKEND
+    indexable = dom_index.supports(name, attrs)
+    indexed = backend == 'index' and indexable
+
     all_results = []
     for item in html:
         if isinstance(item, DomMatch):
+            item = getattr(item, 'document', None) or item.content
+
+        if isinstance(item, dom_index.ParsedDocument):
+            if indexable and not exclude_comments:
+                all_results += __get_indexed_results(item, name, attrs, req)
+                continue
             item = item.content
 
         if exclude_comments:
-            item = re.sub(re.compile('<!--.*?-->', re.DOTALL), '', item)
+            item = comment_re.sub('', item)
+
+        if indexed:
+            all_results += __get_indexed_results(item, name, attrs, req)
+            continue
 
         results = []
         for element in __get_dom_elements(item, name, attrs):
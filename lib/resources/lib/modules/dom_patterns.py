@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Exodus Redux Add-on
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+
+"""
+Bounded LRU of the regexes dom_parser, dom_parser2 and client.parseDOM build per query.
+
+re keeps only 100 compiled patterns and clears all of them when it fills up, which
+happens quickly when several providers parse pages at once.  Patterns compiled here
+stay compiled until they are the least recently used of MAX_PATTERNS.
+"""
+
+MAX_PATTERNS = 256
+
+FLAGS = re.M | re.S | re.I
+
+TEMPLATES = {
+    'element': '(<{tag}(?:\s[^>]*>|/?>))',
+    'quoted': '''(<{tag}[^>]*\s{key}=(?P<delim>['"])(.*?)(?P=delim)[^>]*>)''',
+    'unquoted': '''(<{tag}[^>]*\s{key}=((?:[^\s>]|/>)*)[^>]*>)''',
+    'unquoted2': '''(<{tag}[^>]*\s{key}=([^\s/>]*)[^>]*>)'''
+}
+
+_patterns = OrderedDict()
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def get(tag, key=None, mode='element'):
+    """
+    Returns the compiled pattern for a tag (and attribute key) in one of the TEMPLATES modes
+    :param tag: Tag name as passed to parse_dom
+    :param key: Attribute name, None for 'element'
+    :param mode: 'element', 'quoted', 'unquoted' or 'unquoted2'
+    """
+    return _get((tag, key, mode))
+
+
+def value(pattern):
+    """Returns the compiled attribute value regex client.parseDOM matches with, anchored at the end"""
+    return _get((pattern, None, 'value'))
+
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+        result['size'] = len(_patterns)
+    lookups = result['hits'] + result['misses']
+    result['hit_rate'] = float(result['hits']) / lookups if lookups else 0.0
+    return result
+
+
+def clear():
+    with _lock:
+        _patterns.clear()
+
+
+def _get(cache_key):
+    with _lock:
+        try:
+            pattern = _patterns.pop(cache_key)
+            _patterns[cache_key] = pattern
+            _stats['hits'] += 1
+            return pattern
+        except KeyError:
+            _stats['misses'] += 1
+
+    pattern = _compile(*cache_key)
+
+    with _lock:
+        _patterns[cache_key] = pattern
+        while len(_patterns) > MAX_PATTERNS:
+            _patterns.popitem(last=False)
+            _stats['evictions'] += 1
+
+    return pattern
+
+
+def _compile(tag, key, mode):
+    if mode == 'value':
+        return re.compile(tag + ('$' if tag else ''))
+    return re.compile(TEMPLATES[mode].format(tag=tag, key=key), FLAGS)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Exodus Redux Add-on
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+import time
+import urllib
+
+from resources.lib.modules import cache
+from resources.lib.modules import cleantitle
+from resources.lib.modules import client
+from resources.lib.modules import control
+from resources.lib.modules import trakt
+from resources.lib.modules import workers
+
+"""
+Cross reference of the imdb, tvdb and tmdb ids of movies and shows.
+
+Whatever an indexer learns about a title's ids is kept in the ids table of the
+metacache database, by id and by cleaned title and year, so each title is looked up
+remotely at most once.  Lookups of the same title that run at the same time share one
+remote lookup, and lookups that found nothing are tried again after MISS_DAYS.
+"""
+
+TVDB_BY_IMDB = 'https://thetvdb.com/api/GetSeriesByRemoteID.php?imdbid=%s'
+TVDB_BY_QUERY = 'https://thetvdb.com/api/GetSeries.php?seriesname=%s'
+
+MISS_DAYS = 7
+
+# items per query of shows(), three parameters each stay below sqlite's 999
+CHUNK = 300
+
+def show(imdb='0', tvdb='0', title=None, year=None):
+    # type: (str, str, str, str) -> (str, str)
+    """
+    imdb and tvdb id of a show, from the ids table or looked up with trakt and tvdb
+    :param title: Title to search by when the ids alone aren't enough
+    :return: (imdb, tvdb), '0' for an id that can't be found
+    """
+    if not imdb == '0' and not tvdb == '0':
+        return imdb, tvdb
+
+    key = _key(imdb, tvdb, title, year)
+    stored = _match(_select('show', [key]), *key)
+    if stored:
+        return stored[0], stored[1]
+
+    return workers.single_flight(('ids', 'show') + key, _resolve_show, imdb, tvdb, title, year)
+
+
+def shows(items, resolve=True):
+    """
+    Fills in the imdb and tvdb ids of indexer items in place, the stored ones with a query per
+    CHUNK items and, with resolve, the others looked up on the worker pool
+    """
+    wanted = [i for i in items if i.get('imdb', '0') == '0' or i.get('tvdb', '0') == '0']
+    keys = [_key(i.get('imdb', '0'), i.get('tvdb', '0'), _name(i), i.get('year')) for i in wanted]
+
+    rows = []
+    for r in range(0, len(keys), CHUNK):
+        rows += _select('show', keys[r:r+CHUNK])
+
+    missing = []
+    for item, key in zip(wanted, keys):
+        stored = _match(rows, *key)
+        if stored: item.update({'imdb': stored[0], 'tvdb': stored[1]})
+        else: missing.append(item)
+
+    def resolve(item):
+        imdb, tvdb = show(item.get('imdb', '0'), item.get('tvdb', '0'), _name(item), item.get('year'))
+        item.update({'imdb': imdb, 'tvdb': tvdb})
+
+    if resolve: workers.pool.map(resolve, missing, timeout=30)
+    return items
+
+
+def record(content, imdb='0', tvdb='0', tmdb='0', title=None, year=None):
+    """Stores ids an indexer got along with other data, content being 'movie' or 'show'"""
+    if imdb == '0' and tvdb == '0' and tmdb == '0':
+        return
+    try:
+        dbcon = cache.connect(control.metacacheFile)
+        dbcur = dbcon.cursor()
+        _create_table(dbcur)
+        dbcur.execute(
+            "DELETE FROM ids WHERE type = ? AND ((imdb = ? AND NOT imdb = '0') OR (tvdb = ? AND NOT tvdb = '0') OR title = ?)",
+            (content, imdb, tvdb, _title(title, year)))
+        dbcur.execute(
+            "INSERT INTO ids (type, imdb, tvdb, tmdb, title, time) Values (?, ?, ?, ?, ?, ?)",
+            (content, imdb, tvdb, tmdb, _title(title, year), int(time.time())))
+        cache.commit(dbcon)
+    except Exception:
+        pass
+
+
+def _resolve_show(imdb, tvdb, title, year):
+    if imdb == '0' and title:
+        try:
+            imdb = trakt.SearchTVShow(title, year, full=False)[0]
+            imdb = imdb.get('show', '0')
+            imdb = imdb.get('ids', {}).get('imdb', '0')
+            imdb = 'tt' + re.sub('[^0-9]', '', str(imdb))
+
+            if imdb == 'tt': imdb = '0'
+        except:
+            imdb = '0'
+
+    if tvdb == '0' and not imdb == '0':
+        try:
+            result = client.request(TVDB_BY_IMDB % imdb, timeout='10')
+
+            try: tvdb = client.parseDOM(result, 'seriesid')[0]
+            except: tvdb = '0'
+
+            try: name = client.parseDOM(result, 'SeriesName')[0]
+            except: name = '0'
+            dupe = re.findall('[***]Duplicate (\d*)[***]', name)
+            if dupe: tvdb = str(dupe[0])
+
+            if tvdb == '': tvdb = '0'
+        except:
+            tvdb = '0'
+
+    if tvdb == '0' and title:
+        try:
+            years = [str(year), str(int(year)+1), str(int(year)-1)]
+
+            result = client.request(TVDB_BY_QUERY % urllib.quote_plus(title), timeout='10')
+            result = re.sub(r'[^\x00-\x7F]+', '', result)
+            result = client.replaceHTMLCodes(result)
+            result = client.parseDOM(result, 'Series')
+            result = [(x, client.parseDOM(x, 'SeriesName'), client.parseDOM(x, 'FirstAired')) for x in result]
+            result = [(x, x[1][0], x[2][0]) for x in result if len(x[1]) > 0 and len(x[2]) > 0]
+            result = [x for x in result if cleantitle.get(title) == cleantitle.get(x[1])]
+            result = [x[0][0] for x in result if any(y in x[2] for y in years)][0]
+            tvdb = client.parseDOM(result, 'seriesid')[0]
+
+            if tvdb == '': tvdb = '0'
+        except:
+            tvdb = '0'
+
+    imdb, tvdb = imdb.encode('utf-8'), tvdb.encode('utf-8')
+    if imdb == '0' and tvdb == '0':
+        # a miss is stored as well, _match tries it again after MISS_DAYS
+        _miss('show', title, year)
+    else:
+        record('show', imdb, tvdb, '0', title, year)
+    return imdb, tvdb
+
+
+def _miss(content, title, year):
+    if not _title(title, year):
+        return
+    try:
+        dbcon = cache.connect(control.metacacheFile)
+        dbcur = dbcon.cursor()
+        _create_table(dbcur)
+        dbcur.execute("DELETE FROM ids WHERE type = ? AND title = ?", (content, _title(title, year)))
+        dbcur.execute(
+            "INSERT INTO ids (type, imdb, tvdb, tmdb, title, time) Values (?, '0', '0', '0', ?, ?)",
+            (content, _title(title, year), int(time.time())))
+        cache.commit(dbcon)
+    except Exception:
+        pass
+
+
+def _select(content, keys):
+    imdb = [k[0] for k in keys if not k[0] == '0']
+    tvdb = [k[1] for k in keys if not k[1] == '0']
+    title = [k[2] for k in keys if k[2]]
+    if not imdb + tvdb + title:
+        return []
+    try:
+        dbcon = cache.connect(control.metacacheFile)
+        dbcur = dbcon.cursor()
+        _create_table(dbcur)
+        return dbcur.execute(
+            "SELECT imdb, tvdb, tmdb, title, time FROM ids WHERE type = ? AND (imdb IN (%s) OR tvdb IN (%s) OR title IN (%s)) ORDER BY time DESC" % (
+                ', '.join('?' * len(imdb)), ', '.join('?' * len(tvdb)), ', '.join('?' * len(title))),
+            [content] + imdb + tvdb + title).fetchall()
+    except Exception:
+        return []
+
+
+def _match(rows, imdb, tvdb, title):
+    for row in rows:
+        if (not imdb == '0' and row[0] == imdb) or (not tvdb == '0' and row[1] == tvdb) or (title and row[3] == title):
+            found = (str(row[0]) if imdb == '0' else imdb, str(row[1]) if tvdb == '0' else tvdb)
+            if (found[0] == '0' or found[1] == '0') and time.time() - int(row[4]) > MISS_DAYS * 86400:
+                return None
+            return found
+    return None
+
+
+def _key(imdb, tvdb, title, year):
+    # titles only identify a show that has no id at all, two shows may share a title and year
+    return imdb, tvdb, _title(title, year) if imdb == '0' and tvdb == '0' else None
+
+
+def _name(item):
+    return item.get('title') or item.get('tvshowtitle')
+
+
+def _title(title, year):
+    if not title:
+        return None
+    try: return '%s %s' % (cleantitle.get(title), year or '')
+    except: return None
+
+
+def _create_table(dbcur):
+    dbcur.execute(
+        "CREATE TABLE IF NOT EXISTS ids ("
+        "type TEXT, "
+        "imdb TEXT, "
+        "tvdb TEXT, "
+        "tmdb TEXT, "
+        "title TEXT, "
+        "time INTEGER"
+        ");")
+    dbcur.execute("CREATE INDEX IF NOT EXISTS ids_imdb ON ids (type, imdb)")
+    dbcur.execute("CREATE INDEX IF NOT EXISTS ids_tvdb ON ids (type, tvdb)")
+    dbcur.execute("CREATE INDEX IF NOT EXISTS ids_title ON ids (type, title)")
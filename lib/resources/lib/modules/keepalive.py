@@ -40,6 +40,23 @@ way, it will be closed and removed from the pool.
 To remove the handler, simply re-run build_opener with no arguments, and
 install that opener.
 
+HTTPSHandler does the same for https.  Its connections share one SSL
+context (shared_ssl_context() unless one is passed in), so the CA bundle
+is loaded once rather than per connection.
+
+Each handler keeps its connections in a ConnectionManager, which:
+
+  * caps the pool at MAX_PER_HOST connections per host and MAX_TOTAL
+    overall, evicting the oldest idle connection to make room
+  * closes connections that have been idle for more than IDLE_TIMEOUT
+    seconds
+  * checks an idle socket before reusing it, and drops it if the server
+    has closed it
+  * counts hits, misses, reuses and evictions, see stats()
+
+>>> keepalive_handler.stats()
+{'hits': 9, 'misses': 1, 'reuses': 9, 'evictions': 0, 'open': 1, 'idle': 1}
+
 You can explicitly close connections by using the close_connection()
 method of the returned file-like object (described below) or you can
 use the handler methods:
@@ -108,78 +125,215 @@ EXTRA ATTRIBUTES AND METHODS
 import sys
 import urllib2
 import httplib
+import select
 import socket
 import thread
+import time
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
 
 DEBUG = None
 
+# Pool limits.  A connection that has been idle for longer than IDLE_TIMEOUT
+# seconds is closed rather than reused, most servers will have dropped it by
+# then anyway.  Idle connections are reaped at most every REAP_INTERVAL seconds.
+MAX_PER_HOST = 4
+MAX_TOTAL = 16
+IDLE_TIMEOUT = 60
+REAP_INTERVAL = 15
+
 
 if sys.version_info < (2, 4): HANDLE_ERRORS = 1
 else: HANDLE_ERRORS = 0
 
+_ssl_context = None
+
+def shared_ssl_context():
+    """return the verifying SSL context shared by every HTTPSHandler that
+    isn't given one of its own.  It is created on first use."""
+    global _ssl_context
+    if _ssl_context is None and ssl is not None and hasattr(ssl, 'create_default_context'):
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
 class ConnectionManager:
     """
     The connection manager must be able to:
-      * keep track of all existing
+      * keep track of all existing connections
+      * hand out an idle connection to a host, if there is one
+      * close connections that have been idle for too long
+      * cap the number of connections per host and in total
+      * count hits, misses, reuses and evictions (see stats())
       """
-    def __init__(self):
+    def __init__(self, max_per_host=MAX_PER_HOST, max_total=MAX_TOTAL,
+                 idle_timeout=IDLE_TIMEOUT):
         self._lock = thread.allocate_lock()
         self._hostmap = {} # map hosts to a list of connections
         self._connmap = {} # map connections to host
         self._readymap = {} # map connection to ready state
+        self._idlemap = {} # map connection to the time it became ready
+        self._last_reap = time.time()
+        self._stats = {'hits': 0, 'misses': 0, 'reuses': 0, 'evictions': 0}
+        self.max_per_host = max_per_host
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
 
     def add(self, host, connection, ready):
+        """add a connection to the pool.  If the host or the pool is full,
+        the oldest idle connection is evicted to make room; if every
+        connection is busy, the new one is not pooled and 0 is returned."""
+        evicted = []
         self._lock.acquire()
         try:
+            if len(self._hostmap.get(host, [])) >= self.max_per_host:
+                evicted += self._evict_idle(self._hostmap[host])
+                if len(self._hostmap.get(host, [])) >= self.max_per_host:
+                    return 0
+            if len(self._connmap) >= self.max_total:
+                evicted += self._evict_idle(self._connmap.keys())
+                if len(self._connmap) >= self.max_total:
+                    return 0
             if not host in self._hostmap: self._hostmap[host] = []
             self._hostmap[host].append(connection)
             self._connmap[connection] = host
             self._readymap[connection] = ready
+            if ready: self._idlemap[connection] = time.time()
+            return 1
         finally:
             self._lock.release()
+            for c in evicted: c.close()
 
     def remove(self, connection):
         self._lock.acquire()
         try:
-            try:
-                host = self._connmap[connection]
-            except KeyError:
-                pass
-            else:
-                del self._connmap[connection]
-                del self._readymap[connection]
-                self._hostmap[host].remove(connection)
-                if not self._hostmap[host]: del self._hostmap[host]
+            self._remove(connection)
+        finally:
+            self._lock.release()
+
+    def evict(self, connection):
+        """remove and close a connection that can't be used any more"""
+        self._lock.acquire()
+        try:
+            if self._remove(connection): self._stats['evictions'] += 1
         finally:
             self._lock.release()
+        connection.close()
 
     def set_ready(self, connection, ready):
-        try: self._readymap[connection] = ready
-        except KeyError: pass
+        """returns false if the connection is not (or no longer) pooled"""
+        self._lock.acquire()
+        try:
+            if not connection in self._connmap: return 0
+            self._readymap[connection] = ready
+            if ready: self._idlemap[connection] = time.time()
+            else: self._idlemap.pop(connection, None)
+            return 1
+        finally:
+            self._lock.release()
 
     def get_ready_conn(self, host):
+        now = time.time()
+        if now - self._last_reap > REAP_INTERVAL: self.reap()
         conn = None
+        stale = []
         self._lock.acquire()
         try:
             if host in self._hostmap:
-                for c in self._hostmap[host]:
-                    if self._readymap[c]:
-                        self._readymap[c] = 0
-                        conn = c
-                        break
+                # newest first, it is the least likely to have been dropped
+                for c in reversed(self._hostmap[host]):
+                    if not self._readymap[c]: continue
+                    if now - self._idlemap.get(c, now) > self.idle_timeout:
+                        stale.append(c)
+                        continue
+                    self._readymap[c] = 0
+                    self._idlemap.pop(c, None)
+                    conn = c
+                    break
+            for c in stale:
+                self._remove(c)
+                self._stats['evictions'] += 1
+            if conn is None: self._stats['misses'] += 1
+            else: self._stats['hits'] += 1
         finally:
             self._lock.release()
+            for c in stale: c.close()
         return conn
 
+    def reap(self):
+        """close every idle connection older than idle_timeout"""
+        now = time.time()
+        stale = []
+        self._lock.acquire()
+        try:
+            self._last_reap = now
+            for c, since in self._idlemap.items():
+                if now - since > self.idle_timeout: stale.append(c)
+            for c in stale:
+                self._remove(c)
+                self._stats['evictions'] += 1
+        finally:
+            self._lock.release()
+        for c in stale: c.close()
+        return len(stale)
+
+    def count(self, stat):
+        self._lock.acquire()
+        try:
+            self._stats[stat] += 1
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """return a snapshot of the pool counters:
+             hits       -  an idle connection was handed out
+             misses     -  no idle connection was available
+             reuses     -  a handed out connection answered a request
+             evictions  -  connections closed by the pool itself
+             open/idle  -  connections currently pooled / idle"""
+        self._lock.acquire()
+        try:
+            s = dict(self._stats)
+            s['open'] = len(self._connmap)
+            s['idle'] = len([c for c in self._readymap if self._readymap[c]])
+            return s
+        finally:
+            self._lock.release()
+
     def get_all(self, host=None):
         if host:
             return list(self._hostmap.get(host, []))
         else:
             return dict(self._hostmap)
 
+    def _remove(self, connection):
+        # caller holds the lock
+        try:
+            host = self._connmap[connection]
+        except KeyError:
+            return 0
+        del self._connmap[connection]
+        del self._readymap[connection]
+        self._idlemap.pop(connection, None)
+        self._hostmap[host].remove(connection)
+        if not self._hostmap[host]: del self._hostmap[host]
+        return 1
+
+    def _evict_idle(self, conns):
+        # caller holds the lock, the connections are closed after release
+        idle = [c for c in conns if self._readymap[c]]
+        if not idle: return []
+        oldest = min(idle, key=lambda c: self._idlemap.get(c, 0))
+        self._remove(oldest)
+        self._stats['evictions'] += 1
+        return [oldest]
+
 class KeepAliveHandler:
-    def __init__(self):
-        self._cm = ConnectionManager()
+    def __init__(self, cm=None):
+        if cm is None: cm = ConnectionManager()
+        self._cm = cm
 
     ## Connection Management
     def open_connections(self):
@@ -202,10 +356,16 @@ class KeepAliveHandler:
                 self._cm.remove(h)
                 h.close()
 
+    def stats(self):
+        """return the pool counters, see ConnectionManager.stats()"""
+        return self._cm.stats()
+
     def _request_closed(self, request, host, connection):
         """tells us that this request is now closed and the the
         connection is ready for another request"""
-        self._cm.set_ready(connection, 1)
+        if not self._cm.set_ready(connection, 1):
+            # not pooled (pool full or server asked to close), drop it
+            connection.close()
 
     def _remove_connection(self, host, connection, close=0):
         if close: connection.close()
@@ -219,29 +379,45 @@ class KeepAliveHandler:
         host = req.get_host()
         if not host:
             raise urllib2.URLError('no host given')
+        timeout = getattr(req, 'timeout', socket._GLOBAL_DEFAULT_TIMEOUT)
 
         try:
             h = self._cm.get_ready_conn(host)
             while h:
-                r = self._reuse_connection(h, req, host)
+                if self._is_connection_dropped(h):
+                    # the server has closed the idle connection, don't
+                    # even try to send on it
+                    if DEBUG: DEBUG.info("dropped connection to %s (%d)",
+                                         host, id(h))
+                    self._cm.evict(h)
+                    h = self._cm.get_ready_conn(host)
+                    continue
+
+                r = self._reuse_connection(h, req, host, timeout)
 
                 # if this response is non-None, then it worked and we're
                 # done.  Break out, skipping the else block.
-                if r: break
+                if r:
+                    self._cm.count('reuses')
+                    break
 
                 # connection is bad - possibly closed by server
                 # discard it and ask for the next free connection
-                h.close()
-                self._cm.remove(h)
+                self._cm.evict(h)
                 h = self._cm.get_ready_conn(host)
             else:
                 # no (working) free connections were found.  Create a new one.
-                h = http_class(host)
+                h = http_class(host, timeout=timeout)
                 if DEBUG: DEBUG.info("creating new connection to %s (%d)",
                                      host, id(h))
                 self._cm.add(host, h, 0)
-                self._start_transaction(h, req)
-                r = h.getresponse()
+                try:
+                    self._start_transaction(h, req)
+                    r = h.getresponse(buffering=True)
+                except:
+                    self._cm.remove(h)
+                    h.close()
+                    raise
         except (socket.error, httplib.HTTPException), err:
             raise urllib2.URLError(err)
 
@@ -263,7 +439,17 @@ class KeepAliveHandler:
             return self.parent.error('http', req, r,
                                      r.status, r.msg, r.headers)
 
-    def _reuse_connection(self, h, req, host):
+    def _is_connection_dropped(self, h):
+        """an idle keep-alive socket has nothing to read.  If it is readable
+        the server either closed it or sent something we can't use."""
+        sock = getattr(h, 'sock', None)
+        if sock is None: return True
+        try:
+            return bool(select.select([sock], [], [], 0.0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def _reuse_connection(self, h, req, host, timeout=None):
         """start the transaction with a re-used connection
         return a response object (r) upon success or None on failure.
         This DOES not close or remove bad connections in cases where
@@ -271,11 +457,14 @@ class KeepAliveHandler:
         will close and remove the connection before re-raising.
         """
         try:
+            if timeout is not None and timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                h.timeout = timeout
+                h.sock.settimeout(timeout)
             self._start_transaction(h, req)
-            r = h.getresponse()
+            r = h.getresponse(buffering=True)
             # note: just because we got something back doesn't mean it
             # worked.  We'll check the version below, too.
-        except (socket.error, httplib.HTTPException):
+        except (socket.error, httplib.HTTPException, urllib2.URLError):
             r = None
         except:
             # adding this block just in case we've missed
@@ -289,8 +478,7 @@ class KeepAliveHandler:
             # a DIFFERENT exception
             if DEBUG: DEBUG.error("unexpected exception - closing " + \
                                   "connection to %s (%d)", host, id(h))
-            self._cm.remove(h)
-            h.close()
+            self._cm.evict(h)
             raise
 
         if r is None or r.version == 9:
@@ -319,6 +507,22 @@ class KeepAliveHandler:
 class HTTPHandler(KeepAliveHandler, urllib2.HTTPHandler):
     pass
 
+class HTTPSHandler(KeepAliveHandler, urllib2.HTTPSHandler):
+    """keepalive handler for https.  Every connection it opens uses the
+    same SSL context, so certificates and ciphers are only loaded once."""
+    def __init__(self, context=None, cm=None):
+        KeepAliveHandler.__init__(self, cm)
+        if context is None: context = shared_ssl_context()
+        self._context = context
+
+    def https_open(self, req):
+        return self.do_open(self._https_connection, req)
+
+    def _https_connection(self, host, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        if self._context is None:
+            return HTTPSConnection(host, timeout=timeout)
+        return HTTPSConnection(host, timeout=timeout, context=self._context)
+
 class HTTPResponse(httplib.HTTPResponse):
     # we need to subclass HTTPResponse in order to
     # 1) add readline() and readlines() methods
@@ -339,29 +543,42 @@ class HTTPResponse(httplib.HTTPResponse):
     # modification from socket.py
 
 
-    def __init__(self, sock, debuglevel=0, strict=0, method=None):
-        if method: # the httplib in python 2.3 uses the method arg
-            httplib.HTTPResponse.__init__(self, sock, debuglevel, method)
-        else: # 2.2 doesn't
-            httplib.HTTPResponse.__init__(self, sock, debuglevel)
+    def __init__(self, sock, debuglevel=0, strict=0, method=None, buffering=False):
+        httplib.HTTPResponse.__init__(self, sock, debuglevel, strict=strict,
+                                      method=method, buffering=buffering)
         self.fileno = sock.fileno
         self.code = None
         self._rbuf = ''
         self._rbufsize = 8096
+        self._reading = 0
         self._handler = None # inserted by the handler later
         self._host = None    # (same)
         self._url = None     # (same)
         self._connection = None # (same)
 
-    _raw_read = httplib.HTTPResponse.read
+    def _raw_read(self, amt=None):
+        # httplib closes the response itself once the body has been read
+        # to the end, _reading tells close() that happened
+        self._reading = 1
+        try:
+            return httplib.HTTPResponse.read(self, amt)
+        finally:
+            self._reading = 0
 
     def close(self):
         if self.fp:
+            # a body that wasn't read to the end leaves bytes on the wire,
+            # that connection can't be handed out again
+            complete = self._reading or self.length == 0
             self.fp.close()
             self.fp = None
             if self._handler:
-                self._handler._request_closed(self, self._host,
-                                              self._connection)
+                if complete:
+                    self._handler._request_closed(self, self._host,
+                                                  self._connection)
+                else:
+                    self._handler._remove_connection(self._host,
+                                                     self._connection, close=1)
 
     def close_connection(self):
         self._handler._remove_connection(self._host, self._connection, close=1)
@@ -421,6 +638,9 @@ class HTTPConnection(httplib.HTTPConnection):
     # use the modified response class
     response_class = HTTPResponse
 
+class HTTPSConnection(httplib.HTTPSConnection):
+    response_class = HTTPResponse
+
 #########################################################################
 #####   TEST FUNCTIONS
 #########################################################################
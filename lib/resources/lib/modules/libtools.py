@@ -32,7 +32,10 @@ import urllib
 import urlparse
 import xbmc
 
+from resources.lib.modules import cache
 from resources.lib.modules import control
+from resources.lib.modules import ids
+from resources.lib.modules import metaindex
 from resources.lib.modules import cleantitle
 
 class lib_tools:
@@ -445,6 +448,7 @@ class libepisodes:
                     year, imdb, tvdb = params['year'], params['imdb'], params['tvdb']
 
                     imdb = 'tt' + re.sub('[^0-9]', '', str(imdb))
+                    if imdb == 'tt': imdb = '0'
 
                     try: tmdb = params['tmdb']
                     except: tmdb = '0'
@@ -455,6 +459,9 @@ class libepisodes:
 
             items = [i for x, i in enumerate(items) if i not in items[x + 1:]]
             if len(items) == 0: raise Exception()
+
+            # strm files written without an id get it looked up once for all of them
+            ids.shows(items)
         except:
             return
 
@@ -618,5 +625,12 @@ class libepisodes:
             except:
                 pass
 
+            try:
+                if not (control.player.isPlaying() or control.condVisibility('Library.IsScanningVideo')):
+                    cache.maintenance()
+                    metaindex.update()
+            except:
+                pass
+
             control.sleep(10000)
 
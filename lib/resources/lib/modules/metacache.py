@@ -17,9 +17,13 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+import threading
 import time
 
+from resources.lib.modules import cache
+from resources.lib.modules import cache_codec
 from resources.lib.modules import control
+from resources.lib.modules import metaindex
 
 try:
     from sqlite3 import dbapi2 as database
@@ -30,26 +34,42 @@ except Exception:
 def fetch(items, lang='en', user=''):
     try:
         t2 = int(time.time())
-        dbcon = database.connect(control.metacacheFile)
+        dbcon = cache.connect(control.metacacheFile)
         dbcur = dbcon.cursor()
+        _create_table(dbcur)
+    except Exception:
+        return items
+
+    imdbs = list(set(i.get('imdb', '0') for i in items) - set(['0']))
+    tvdbs = list(set(i.get('tvdb', '0') for i in items) - set(['0']))
+    by_imdb, by_tvdb = {}, {}
+
+    try:
+        # one query per chunk instead of one per item, kept below SQLITE_MAX_VARIABLE_NUMBER
+        for column, ids, matches in (('imdb', imdbs, by_imdb), ('tvdb', tvdbs, by_tvdb)):
+            for r in range(0, len(ids), 500):
+                chunk = ids[r:r+500]
+                dbcur.execute(
+                    "SELECT imdb, tvdb, item, time, format FROM meta WHERE %s IN (%s) AND lang = ? AND user = ?"
+                    % (column, ','.join('?' * len(chunk))), chunk + [lang, user])
+                for match in dbcur.fetchall():
+                    matches[match[0] if column == 'imdb' else match[1]] = match
     except Exception:
         return items
 
     for i in range(0, len(items)):
         try:
-            dbcur.execute(
-                "SELECT * FROM meta WHERE (imdb = '%s' and lang = '%s' and user = '%s' and not imdb = '0') or (tvdb = '%s' and lang = '%s' and user = '%s' and not tvdb = '0')"
-                % (items[i]['imdb'],
-                   lang, user, items[i]['tvdb'],
-                   lang, user))
-            match = dbcur.fetchone()
-
-            t1 = int(match[5])
-            update = (abs(t2 - t1) / 3600) >= 720
-            if update is True:
-                raise Exception()
+            match = by_imdb.get(items[i].get('imdb', '0')) or by_tvdb.get(items[i].get('tvdb', '0'))
+            if match is None:
+                continue
+
+            t1 = int(match[3])
+            item = cache_codec.decode(match[4], match[2])
 
-            item = eval(match[4].encode('utf-8'))
+            # an empty item records a lookup that failed, it is only trusted for a short while
+            expiry = 720 * 3600 if item else cache.negative_ttl()
+            if abs(t2 - t1) >= expiry:
+                raise Exception()
             item = dict((k, v) for k, v in item.iteritems() if not v == '0')
 
             items[i].update(item)
@@ -60,80 +80,120 @@ def fetch(items, lang='en', user=''):
     return items
 
 
+def _create_table(dbcur):
+    dbcur.execute(
+        "CREATE TABLE IF NOT EXISTS meta ("
+        "imdb TEXT, "
+        "tvdb TEXT, "
+        "lang TEXT, "
+        "user TEXT, "
+        "item TEXT, "
+        "time TEXT, "
+        "format TEXT, "
+        "UNIQUE(imdb, tvdb, lang, user)"
+        ");")
+    # rows written before the format column are repr() and decode as such
+    columns = [column[1] for column in dbcur.execute("PRAGMA table_info(meta)").fetchall()]
+    if 'format' not in columns:
+        dbcur.execute("ALTER TABLE meta ADD COLUMN format TEXT")
+    dbcur.execute("CREATE INDEX IF NOT EXISTS meta_imdb ON meta (imdb, lang, user)")
+    dbcur.execute("CREATE INDEX IF NOT EXISTS meta_tvdb ON meta (tvdb, lang, user)")
+
+
 def insert(meta):
     try:
-        control.makeFile(control.dataPath)
-        dbcon = database.connect(control.metacacheFile)
+        dbcon = cache.connect(control.metacacheFile)
         dbcur = dbcon.cursor()
-        dbcur.execute(
-            "CREATE TABLE IF NOT EXISTS meta ("
-            "imdb TEXT, "
-            "tvdb TEXT, "
-            "lang TEXT, "
-            "user TEXT, "
-            "item TEXT, "
-            "time TEXT, "
-            "UNIQUE(imdb, tvdb, lang, user)"
-            ");")
+        _create_table(dbcur)
         t = int(time.time())
+        rows = []
         for m in meta:
             try:
-                if "user" not in m:
-                    m["user"] = ''
-                if "lang" not in m:
-                    m["lang"] = 'en'
-                i = repr(m['item'])
-                try:
-                    dbcur.execute(
-                        "DELETE * FROM meta WHERE (imdb = '%s' and lang = '%s' and user = '%s' and not imdb = '0') or (tvdb = '%s' and lang = '%s' and user = '%s' and not tvdb = '0')"
-                        % (m['imdb'],
-                           m['lang'],
-                           m['user'],
-                           m['tvdb'],
-                           m['lang'],
-                           m['user']))
-                except Exception:
-                    pass
-                dbcur.execute("INSERT INTO meta Values (?, ?, ?, ?, ?, ?)",
-                              (m['imdb'], m['tvdb'], m['lang'], m['user'], i, t))
+                fmt, item = cache_codec.encode(m['item'])
+                rows.append((m['imdb'], m['tvdb'], m.get('lang') or 'en', m.get('user', ''), item, t, fmt))
             except Exception:
                 pass
 
-        dbcon.commit()
+        # rows of the same title stored under an older imdb/tvdb pairing are replaced too
+        dbcur.executemany(
+            "DELETE FROM meta WHERE imdb = ? AND lang = ? AND user = ? AND NOT imdb = '0'",
+            [(r[0], r[2], r[3]) for r in rows])
+        dbcur.executemany(
+            "DELETE FROM meta WHERE tvdb = ? AND lang = ? AND user = ? AND NOT tvdb = '0'",
+            [(r[1], r[2], r[3]) for r in rows])
+        dbcur.executemany(
+            "INSERT OR REPLACE INTO meta (imdb, tvdb, lang, user, item, time, format) Values (?, ?, ?, ?, ?, ?, ?)",
+            rows)
+
+        cache.commit(dbcon)
     except Exception:
         return
 
 
+class Writer(object):
+    """
+    Inserts the entries super_info appends to a meta list in batches while the list is still being built
+    :param meta: List the entries are appended to
+    :param size: Number of new entries that triggers an insert
+    """
+    def __init__(self, meta, size=20):
+        self.meta = meta
+        self.size = size
+        self.written = 0
+        self._lock = threading.Lock()
+
+    def flush(self, *args):
+        self._write(False)
+
+    def close(self):
+        self._write(True)
+
+    def _write(self, force):
+        with self._lock:
+            if len(self.meta) - self.written < (1 if force else self.size):
+                return
+            batch = self.meta[self.written:]
+            self.written += len(batch)
+            insert(batch)
+
+
 def local(items, link, poster, fanart):
     try:
-        dbcon = database.connect(control.metaFile())
-        dbcur = dbcon.cursor()
-        args = [i['imdb'] for i in items]
-        dbcur.execute('SELECT * FROM mv WHERE imdb IN (%s)' % ', '.join(list(map(lambda arg:  "'%s'" % arg, args))))
-        data = dbcur.fetchall()
+        lookup = metaindex.get().lookup
     except Exception:
-        return items
+        # no index yet, it's being built in the background
+        try:
+            dbcon = database.connect(control.metaFile())
+            dbcur = dbcon.cursor()
+            args = [i['imdb'] for i in items]
+            dbcur.execute('SELECT * FROM mv WHERE imdb IN (%s)' % ', '.join('?' * len(args)), args)
+            data = dict((x[1], (x[2], x[3])) for x in dbcur.fetchall())
+            lookup = data.get
+        except Exception:
+            return items
 
     for i in range(0, len(items)):
         try:
             item = items[i]
 
-            match = [x for x in data if x[1] == item['imdb']][0]
+            match = lookup(item['imdb'])
+            if match is None:
+                continue
 
             try:
                 if poster in item and not item[poster] == '0':
                     raise Exception()
-                if match[2] == '0':
+                if match[0] == '0':
                     raise Exception()
-                items[i].update({poster: link % ('300', '/%s.jpg' % match[2])})
+                items[i].update({poster: link % ('300', '/%s.jpg' % match[0])})
             except Exception:
                 pass
             try:
                 if fanart in item and not item[fanart] == '0':
                     raise Exception()
-                if match[3] == '0':
+                if match[1] == '0':
                     raise Exception()
-                items[i].update({fanart: link % ('1280', '/%s.jpg' % match[3])})
+                items[i].update({fanart: link % ('1280', '/%s.jpg' % match[1])})
             except Exception:
                 pass
         except Exception:
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Exodus Redux Add-on
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from resources.lib.modules import control
+from resources.lib.modules import workers
+
+try:
+    from sqlite3 import dbapi2 as database
+except Exception:
+    from pysqlite2 import dbapi2 as database
+
+'''
+Read-only artwork index built from the mv table of the bundled metadata database.
+
+The database never changes between metadata addon updates, so it is converted once
+into a file of fixed size records sorted by imdb number, followed by the poster and
+fanart ids they point into.  Lookups binary search the memory-mapped records, which
+costs a few page reads whatever the size of the list or of the database.
+The library service builds it with update(), a listing that finds it missing starts
+the build in the background and queries the database in the meantime.
+
+Layout, little endian:
+    header   MAGIC, record count, source mtime, source size
+    records  imdb number, poster offset, fanart offset    (uint32 each)
+    strings  poster and fanart ids, each a length byte followed by the id
+Offset 0 stands for no artwork ('0' in the database).
+'''
+
+MAGIC = 'EXMI0001'
+HEADER = struct.Struct('<8sIqq')
+RECORD = struct.Struct('<III')
+
+_index = []
+_lock = threading.Lock()
+_build_lock = threading.Lock()
+# (mtime, size) of the database the index on disk was last found or built for
+_checked = []
+
+
+class ArtworkIndex(object):
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.mtime, self.size = HEADER.unpack_from(self._map, 0)
+        if not magic == MAGIC:
+            self.close()
+            raise ValueError('not an artwork index')
+
+    def lookup(self, imdb):
+        # type: (str) -> (str, str) or None
+        """(poster id, fanart id) for an imdb id like 'tt0111161', '0' where there is none"""
+        try:
+            number = int(imdb[2:]) if imdb.startswith('tt') else int(imdb)
+        except (ValueError, AttributeError):
+            return None
+        if number <= 0:
+            return None
+
+        data, lo, hi = self._map, 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key, poster, fanart = RECORD.unpack_from(data, HEADER.size + mid * RECORD.size)
+            if key < number:
+                lo = mid + 1
+            elif key > number:
+                hi = mid
+            else:
+                return self._string(poster), self._string(fanart)
+        return None
+
+    def _string(self, offset):
+        if not offset:
+            return '0'
+        length = ord(self._map[offset])
+        return self._map[offset + 1:offset + 1 + length]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def get():
+    """The index of control.metaFile(), None if there is no metadata addon or the index isn't built yet"""
+    with _lock:
+        source = control.metaFile()
+        if not source or not os.path.exists(source):
+            return None
+        stat = os.stat(source)
+
+        if _index:
+            index = _index[0]
+            if index.mtime == int(stat.st_mtime) and index.size == stat.st_size:
+                return index
+            index.close()
+            del _index[:]
+
+        path = _path()
+        try:
+            index = _open(path, stat)
+        except Exception:
+            workers.Thread(_build_once, source, path, stat).start()
+            return None
+
+        _index.append(index)
+        return index
+
+
+def update():
+    """Builds the index when it is missing or outdated, for the library service to call"""
+    source = control.metaFile()
+    if not source or not os.path.exists(source):
+        return
+    stat = os.stat(source)
+    # the service calls this every few seconds, the index is only opened when the database changed
+    if _checked == [(int(stat.st_mtime), stat.st_size)]:
+        return
+    path = _path()
+    try:
+        _open(path, stat).close()
+    except Exception:
+        _build_once(source, path, stat)
+        try: _open(path, stat).close()
+        except Exception: return
+    _checked[:] = [(int(stat.st_mtime), stat.st_size)]
+
+
+def _open(path, stat):
+    index = ArtworkIndex(path)
+    if not (index.mtime == int(stat.st_mtime) and index.size == stat.st_size):
+        index.close()
+        raise ValueError('outdated artwork index')
+    return index
+
+
+def _build_once(source, path, stat):
+    # one build at a time, a second caller keeps using the database
+    if not _build_lock.acquire(False):
+        return
+    try:
+        build(source, path, stat)
+    except Exception:
+        pass
+    finally:
+        _build_lock.release()
+
+
+def _path():
+    return os.path.join(control.dataPath, 'meta_art.idx')
+
+
+def build(source, path, stat=None):
+    """Writes the index of the mv table in source to path"""
+    stat = stat or os.stat(source)
+    dbcon = database.connect(source)
+    try:
+        rows = dbcon.execute('SELECT * FROM mv').fetchall()
+    finally:
+        dbcon.close()
+
+    records = {}
+    for row in rows:
+        try:
+            imdb = str(row[1])
+            number = int(imdb[2:]) if imdb.startswith('tt') else int(imdb)
+            records[number] = (_ascii(row[2]), _ascii(row[3]))
+        except Exception:
+            pass
+
+    strings = []
+    offsets = {}
+    position = [HEADER.size + len(records) * RECORD.size]
+
+    def offset(value):
+        if not value or value == '0' or len(value) > 255:
+            return 0
+        if value not in offsets:
+            offsets[value] = position[0]
+            strings.append(chr(len(value)) + value)
+            position[0] += 1 + len(value)
+        return offsets[value]
+
+    body = [RECORD.pack(number, offset(records[number][0]), offset(records[number][1])) for number in sorted(records)]
+
+    control.makeFile(control.dataPath)
+    # a name of its own, other plugin runs may be building the same index
+    handle, temp = tempfile.mkstemp(prefix='meta_art.', suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(handle, 'wb') as fh:
+            fh.write(HEADER.pack(MAGIC, len(records), int(stat.st_mtime), stat.st_size))
+            fh.write(''.join(body))
+            fh.write(''.join(strings))
+        try:
+            os.rename(temp, path)
+        except OSError:
+            # windows doesn't rename over an existing file
+            os.remove(path)
+            os.rename(temp, path)
+    except Exception:
+        try: os.remove(temp)
+        except: pass
+        raise
+
+
+def _ascii(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value) if value is not None else '0'
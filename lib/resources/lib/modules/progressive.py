@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Exodus Redux Add-on
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+
+from resources.lib.modules import control
+
+"""
+Progressive listing of movie and tv show directories.
+
+An indexer whose items are not all in the metacache lists what it has straight away,
+enriches the rest after the directory is out and then refreshes the container, which
+lists again from the now complete metacache.  The refresh it asked for is recognised
+by a window property and always lists the complete way, so items that keep failing
+can't cause a refresh loop.  Set the plugin's progressive.listing setting to false to
+always wait for the complete list.
+"""
+
+PROPERTY = 'exodusredux.progressive'
+
+# seconds within which a listing of the same path counts as the refresh that was asked for
+REFRESH_WINDOW = 60
+
+
+def enabled():
+    try: return not control.setting('progressive.listing') == 'false'
+    except: return True
+
+
+def path():
+    try: return sys.argv[0] + sys.argv[2]
+    except: return ''
+
+
+def refreshed():
+    """Whether this listing is the refresh a progressive listing of the same path asked for"""
+    try:
+        value = control.window.getProperty(PROPERTY)
+        if not value: return False
+        listed, stamp = value.rsplit('|', 1)
+        if not listed == path(): return False
+        control.window.clearProperty(PROPERTY)
+        return time.time() - float(stamp) < REFRESH_WINDOW
+    except:
+        return False
+
+
+def refresh():
+    """Refreshes the container, unless the user already left the listing"""
+    current = path()
+    if not current or not control.infoLabel('Container.FolderPath') == current:
+        return
+    control.window.setProperty(PROPERTY, '%s|%s' % (current, time.time()))
+    control.refresh()
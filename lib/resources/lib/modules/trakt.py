@@ -31,6 +31,7 @@ from resources.lib.modules import client
 from resources.lib.modules import control
 from resources.lib.modules import log_utils
 from resources.lib.modules import utils
+from resources.lib.modules import workers
 
 BASE_URL = 'https://api.trakt.tv'
 #BASE_URL = 'https://api-v2launch.trakt.tv'
@@ -61,6 +62,7 @@ def __getTrakt(url, post=None):
             return
         elif resp_code in ['429']:
             log_utils.log('Trakt Rate Limit Reached: %s' % resp_code, log_utils.LOGWARNING)
+            workers.throttled()
             return
 
         if resp_code not in ['401', '405']:
@@ -297,8 +299,30 @@ def getWatchedActivity():
         pass
 
 
+def getEpisodesActivity():
+    try:
+        i = getTraktAsJson('/sync/last_activities')
+
+        activity = []
+        activity.append(i['episodes']['watched_at'])
+        activity.append(i['episodes']['collected_at'])
+        activity.append(i['episodes']['paused_at'])
+        activity.append(i['shows']['watchlisted_at'])
+        activity.append(i['shows']['hidden_at'])
+        activity = [int(cleandate.iso_2_utc(i)) for i in activity]
+        activity = sorted(activity, key=int)[-1]
+
+        return activity
+    except:
+        pass
+
+
+def userCacheTag():
+    return 'trakt.user:%s' % control.setting('trakt.user').strip()
+
+
 def cachesyncMovies(timeout=0):
-    indicators = cache.get(syncMovies, timeout, control.setting('trakt.user').strip())
+    indicators = cache.get(syncMovies, timeout, control.setting('trakt.user').strip(), tags=[userCacheTag()])
     return indicators
 
 
@@ -319,7 +343,7 @@ def syncMovies(user):
 
 
 def cachesyncTVShows(timeout=0):
-    indicators = cache.get(syncTVShows, timeout, control.setting('trakt.user').strip())
+    indicators = cache.get(syncTVShows, timeout, control.setting('trakt.user').strip(), tags=[userCacheTag()])
     return indicators
 
 
@@ -351,32 +375,39 @@ def syncSeason(imdb):
         pass
 
 
+def __syncHistory(url, post):
+    # the user's watched indicators and lists are out of date once the history changed
+    result = __getTrakt(url, post)[0]
+    cache.invalidate_tag(userCacheTag())
+    return result
+
+
 def markMovieAsWatched(imdb):
     if not imdb.startswith('tt'): imdb = 'tt' + imdb
-    return __getTrakt('/sync/history', {"movies": [{"ids": {"imdb": imdb}}]})[0]
+    return __syncHistory('/sync/history', {"movies": [{"ids": {"imdb": imdb}}]})
 
 
 def markMovieAsNotWatched(imdb):
     if not imdb.startswith('tt'): imdb = 'tt' + imdb
-    return __getTrakt('/sync/history/remove', {"movies": [{"ids": {"imdb": imdb}}]})[0]
+    return __syncHistory('/sync/history/remove', {"movies": [{"ids": {"imdb": imdb}}]})
 
 
 def markTVShowAsWatched(tvdb):
-    return __getTrakt('/sync/history', {"shows": [{"ids": {"tvdb": tvdb}}]})[0]
+    return __syncHistory('/sync/history', {"shows": [{"ids": {"tvdb": tvdb}}]})
 
 
 def markTVShowAsNotWatched(tvdb):
-    return __getTrakt('/sync/history/remove', {"shows": [{"ids": {"tvdb": tvdb}}]})[0]
+    return __syncHistory('/sync/history/remove', {"shows": [{"ids": {"tvdb": tvdb}}]})
 
 
 def markEpisodeAsWatched(tvdb, season, episode):
     season, episode = int('%01d' % int(season)), int('%01d' % int(episode))
-    return __getTrakt('/sync/history', {"shows": [{"seasons": [{"episodes": [{"number": episode}], "number": season}], "ids": {"tvdb": tvdb}}]})[0]
+    return __syncHistory('/sync/history', {"shows": [{"seasons": [{"episodes": [{"number": episode}], "number": season}], "ids": {"tvdb": tvdb}}]})
 
 
 def markEpisodeAsNotWatched(tvdb, season, episode):
     season, episode = int('%01d' % int(season)), int('%01d' % int(episode))
-    return __getTrakt('/sync/history/remove', {"shows": [{"seasons": [{"episodes": [{"number": episode}], "number": season}], "ids": {"tvdb": tvdb}}]})[0]
+    return __syncHistory('/sync/history/remove', {"shows": [{"seasons": [{"episodes": [{"number": episode}], "number": season}], "ids": {"tvdb": tvdb}}]})
 
 
 def getMovieTranslation(id, lang, full=False):
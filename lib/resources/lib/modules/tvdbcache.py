@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Exodus Redux Add-on
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+import StringIO
+import time
+import urllib2
+import zipfile
+from xml.etree import cElementTree as ElementTree
+
+from resources.lib.modules import cache
+from resources.lib.modules import cache_codec
+from resources.lib.modules import control
+from resources.lib.modules import workers
+
+"""
+Store of the TVDB series zips seasons.tvdb_list reads.
+
+A zip holds the whole show: the series record, every episode and the banners.  It is
+parsed as it is read with iterparse, keeping only the fields the indexers use, and the
+result is stored in the metacache database by tvdb id and language along with the
+series' lastupdated stamp.  The season list and every season of a show are then built
+from one download instead of one each.
+
+Past TTL a stored show is checked against tvdb's list of the shows updated in the last
+week, so only shows that actually changed are downloaded again.
+"""
+
+FIELDS = {
+    'Series': ('id', 'SeriesName', 'Overview', 'IMDB_ID', 'Status', 'Network', 'Genre', 'Runtime', 'Rating',
+               'RatingCount', 'ContentRating', 'Actors', 'FirstAired', 'poster', 'banner', 'fanart', 'lastupdated'),
+    'Episode': ('id', 'SeasonNumber', 'EpisodeNumber', 'EpisodeName', 'Overview', 'FirstAired', 'filename',
+                'Rating', 'Director', 'Writer'),
+    'Banner': ('BannerPath', 'BannerType', 'Language', 'Season')
+}
+
+# hours a stored show is used before it is checked for updates, ended shows rarely change
+TTL = 24
+TTL_ENDED = 168
+
+# stored shows younger than this are downloaded again only when the updates list has them
+UPDATES_DAYS = 7
+
+
+def get(link, tvdb, lang='en'):
+    # type: (str, str, str) -> dict or None
+    """
+    A show from the store, downloaded first when missing or outdated
+    :param link: Zip url with %s for the tvdb id and the language, as seasons.tvdb_info_link
+    :return: {'id': tvdb id, 'series': {field: text}, 'episodes': [{field: text}], 'banners': [{field: text}]}
+             with the id of the original show when tvdb marks this one as a duplicate, None if it can't be had
+    """
+    stored, stamp = _select(tvdb, lang)
+    if stored and _fresh(link, tvdb, stored, stamp):
+        return stored
+
+    # the episodes of a show in a calendar all want the same zip
+    return workers.single_flight(('tvdb', tvdb, lang), _refresh, link, tvdb, lang, stored)
+
+
+def updates(link):
+    """{tvdb id: time of the last change} of the shows tvdb changed in the past week, None if unavailable"""
+    return cache.get(_updates, 1, link.split('/series/')[0] + '/updates/updates_week.zip')
+
+
+def _fresh(link, tvdb, bundle, stamp):
+    age = time.time() - stamp
+    if age < (TTL_ENDED if bundle['series'].get('Status') == 'Ended' else TTL) * 3600:
+        return True
+    if age > UPDATES_DAYS * 86400:
+        return False
+    try: return updates(link).get(str(tvdb), 0) < stamp
+    except: return False
+
+
+def _updates(url):
+    data = urllib2.urlopen(url, timeout=30).read()
+    archive = zipfile.ZipFile(StringIO.StringIO(data))
+    try:
+        changed = {}
+        for tag, record in _records(archive.open(archive.namelist()[0]), ('Series', 'Episode', 'Banner')):
+            # episodes name their show in a Series field, banners are left out as the lists don't use them
+            if tag == 'Banner': continue
+            series = record.get('id') if tag == 'Series' else record.get('Series')
+            changed[series] = max(changed.get(series, 0), int(record.get('time') or 0))
+    finally:
+        archive.close()
+    return changed
+
+
+def _refresh(link, tvdb, lang, stored):
+    try:
+        bundle = download(link, tvdb, lang)
+        dupe = re.compile('[***]Duplicate (\d*)[***]').findall(bundle['series'].get('SeriesName', ''))
+        if dupe and not dupe[0] == tvdb:
+            bundle = download(link, str(dupe[0]), lang)
+    except Exception:
+        # an outdated show beats none when tvdb can't be reached
+        return stored
+
+    insert(tvdb, lang, bundle)
+    return bundle
+
+
+def download(link, tvdb, lang='en'):
+    """Downloads and parses a show, banners only for English as that's the only language they are used in"""
+    data = urllib2.urlopen(link % (tvdb, lang), timeout=30).read()
+    archive = zipfile.ZipFile(StringIO.StringIO(data))
+    try:
+        bundle = {'id': tvdb, 'series': {}, 'episodes': [], 'banners': []}
+        for tag, record in _parse(archive.open('%s.xml' % lang)):
+            if tag == 'Series': bundle['series'] = record
+            elif tag == 'Episode': bundle['episodes'].append(record)
+        if lang == 'en':
+            bundle['banners'] = [record for tag, record in _parse(archive.open('banners.xml'))]
+    finally:
+        archive.close()
+    return bundle
+
+
+def insert(tvdb, lang, bundle):
+    try:
+        dbcon = cache.connect(control.metacacheFile)
+        dbcur = dbcon.cursor()
+        _create_table(dbcur)
+        fmt, data = cache_codec.encode(bundle)
+        dbcur.execute(
+            "INSERT OR REPLACE INTO tvdb (tvdb, lang, updated, time, format, data) Values (?, ?, ?, ?, ?, ?)",
+            (tvdb, lang, bundle['series'].get('lastupdated', ''), int(time.time()), fmt, data))
+        cache.commit(dbcon)
+    except Exception:
+        pass
+
+
+def _select(tvdb, lang):
+    try:
+        dbcon = cache.connect(control.metacacheFile)
+        dbcur = dbcon.cursor()
+        _create_table(dbcur)
+        row = dbcur.execute("SELECT time, format, data FROM tvdb WHERE tvdb = ? AND lang = ?", (tvdb, lang)).fetchone()
+        bundle = cache_codec.decode(row[1], row[2])
+    except Exception:
+        return None, 0
+    return bundle, int(row[0])
+
+
+def _parse(source):
+    for tag, record in _records(source, FIELDS):
+        fields = FIELDS[tag]
+        yield tag, dict((k, v) for k, v in record.iteritems() if k in fields)
+
+
+def _records(source, tags):
+    """
+    (tag, {field: text}) of every record of the given tags, text comes unescaped from the parser.
+    The root is cleared after each record so a long running show is never in memory as a tree.
+    """
+    root = None
+    for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+        if root is None:
+            root = elem
+        # records are the root's children, a Series field inside an episode has no children
+        elif event == 'end' and elem.tag in tags and len(elem):
+            yield elem.tag, dict((child.tag, (child.text or '').strip()) for child in elem)
+            root.clear()
+
+
+def _create_table(dbcur):
+    dbcur.execute(
+        "CREATE TABLE IF NOT EXISTS tvdb ("
+        "tvdb TEXT, "
+        "lang TEXT, "
+        "updated TEXT, "
+        "time INTEGER, "
+        "format TEXT, "
+        "data BLOB, "
+        "UNIQUE(tvdb, lang)"
+        ");")
@@ -18,7 +18,10 @@
 '''
 
 
+import Queue
 import threading
+import time
+from contextlib import contextmanager
 
 
 class Thread(threading.Thread):
@@ -29,3 +32,226 @@ class Thread(threading.Thread):
     def run(self):
         self._target(*self._args)
 
+
+'''
+Shared pool the indexers enrich their lists on.
+
+Work is queued item by item and taken by up to `limit` threads, so a slow item only
+holds up its own thread instead of a whole batch of 40.  The limit adapts to the remote
+services: it grows by one after `limit` calls in a row that were fast enough, shrinks
+by a quarter when the slowest request of a call, as reported through observe(), takes
+longer than target_latency and halves when a service reported rate limiting through
+throttled().  Threads leave after idle_timeout without work.
+
+Python threads can't be stopped, so a call that overruns its deadline keeps running on
+its thread; map() just stops waiting for it and another thread takes its place.  Such a
+call must not write its result any more, see Pool.result().
+'''
+
+_throttle = [0]
+_local = threading.local()
+
+
+def throttled():
+    """Called when a remote service answered 429, lowers the concurrency of the pool"""
+    _throttle[0] += 1
+
+
+def observe(seconds):
+    """Called with the duration of a remote request, the pool adapts to the slowest request of each call"""
+    task = getattr(_local, 'task', None)
+    if task is not None:
+        task.slowest = max(task.slowest, seconds)
+
+
+class _Task(object):
+    def __init__(self, target, item, callback):
+        self.target = target
+        self.item = item
+        self.callback = callback
+        self.started = threading.Event()
+        self.done = threading.Event()
+        self.start = None
+        self.slowest = 0.0
+        self.abandoned = False
+
+    def run(self):
+        self.start = time.time()
+        self.started.set()
+        _local.task = self
+        try:
+            self.target(self.item)
+            if self.callback: self.callback(self.item)
+        except:
+            pass
+        _local.task = None
+        self.done.set()
+        # calls that made no observed request are judged by their own duration
+        return self.slowest or time.time() - self.start
+
+
+class Pool(object):
+    def __init__(self, min_workers=4, max_workers=40, target_latency=3.0, idle_timeout=1.0):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.target_latency = target_latency
+        self.idle_timeout = idle_timeout
+        self.limit = (min_workers + max_workers) // 2
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = 0
+        self._fast = 0
+        self._lowered = 0.0
+        self._throttle = _throttle[0]
+
+    @contextmanager
+    def result(self):
+        """
+        Held by a call while it writes its result, map() can't give up on the call in the meantime
+        :return: False when map() no longer waits for the call, its result must then be dropped
+        """
+        task = getattr(_local, 'task', None)
+        with self._lock:
+            yield task is None or not task.abandoned
+
+    def map(self, target, items, timeout=None, callback=None):
+        """
+        Calls target(item) for every item and waits for the calls to finish
+        :param timeout: Seconds each call may run, calls still running after that are no longer waited for
+        :param callback: Called with the item on the pool thread once target(item) returned
+        :return: Items whose call did not finish in time
+        """
+        tasks = [_Task(target, item, callback) for item in items]
+        for task in tasks: self._queue.put(task)
+        self._spawn()
+
+        unfinished = []
+        for task in tasks:
+            task.started.wait()
+            if timeout is None:
+                task.done.wait()
+                continue
+            task.done.wait(max(0, task.start + timeout - time.time()))
+            if not task.done.is_set():
+                self._abandon(task)
+                unfinished.append(task.item)
+        return unfinished
+
+    def _abandon(self, task):
+        with self._lock:
+            if task.done.is_set():
+                return
+            # its thread no longer counts against the limit and leaves once the call returns
+            task.abandoned = True
+            self._workers -= 1
+        self._spawn()
+
+    def _spawn(self):
+        with self._lock:
+            count = min(self.limit, self._workers + self._queue.qsize()) - self._workers
+            self._workers += max(0, count)
+        for i in range(count):
+            Thread(self._run).start()
+
+    def _run(self):
+        while True:
+            try:
+                task = self._queue.get(timeout=self.idle_timeout)
+            except Queue.Empty:
+                with self._lock:
+                    if not self._queue.empty():
+                        continue
+                    self._workers -= 1
+                    return
+
+            latency = task.run()
+
+            with self._lock:
+                if task.abandoned:
+                    return
+                self._adapt(latency)
+                if self._workers > self.limit:
+                    self._workers -= 1
+                    return
+            self._spawn()
+
+    def _adapt(self, latency):
+        throttled = not self._throttle == _throttle[0]
+        self._throttle = _throttle[0]
+
+        if throttled or latency > self.target_latency:
+            self._fast = 0
+            # one reduction per target_latency, the calls in flight report the same slowdown
+            if time.time() - self._lowered < self.target_latency:
+                return
+            self._lowered = time.time()
+            self.limit = max(self.min_workers, self.limit // 2 if throttled else self.limit * 3 // 4)
+        else:
+            self._fast += 1
+            if self._fast >= self.limit and self.limit < self.max_workers:
+                self.limit += 1
+                self._fast = 0
+
+
+class Flight(object):
+    """
+    A call for one key in progress, other threads missing on the same key wait for it
+    instead of making the call again.  completed tells a call that returned, even with
+    an empty result, from one that raised.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.completed = False
+        self.result = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def board(key, join=True):
+    """
+    The flight of key, started when there is none
+    :param join: Return None instead of a flight in progress
+    :return: (flight, leader), the leader has to land() the flight once its call is over
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is None:
+            flight = _flights[key] = Flight()
+            return flight, True
+    return (flight if join else None), False
+
+
+def land(key, flight):
+    """Ends the flight of key and wakes the threads waiting for it"""
+    with _flights_lock:
+        if _flights.get(key) is flight:
+            del _flights[key]
+    flight.done.set()
+
+
+def single_flight(key, function, *args):
+    """
+    Calls function(*args) unless a call for the same key is already running, then waits for that one
+    :return: What the call returned, followers that waited in vain for a minute or whose leader
+             raised call function themselves
+    """
+    flight, leader = board(key)
+
+    if not leader:
+        flight.done.wait(60)
+        if flight.completed:
+            return flight.result
+        return function(*args)
+
+    try:
+        flight.result = function(*args)
+        flight.completed = True
+    finally:
+        land(key, flight)
+    return flight.result
+
+
+pool = Pool()